@@ -0,0 +1,127 @@
+'''
+* amenityindex.py
+*
+* A small 'sidecar' index saved next to an OSM shapefile, listing every feature with an 'amenity' tag.
+*
+* Filtering a city-sized shapefile for cafes means decoding every single feature in the bounding box just
+* to look at one attribute. Instead, the shapefile is scanned once, and for each amenity value (cafe, pub,
+* restaurant...) the feature ids and bounding boxes of the matching features are saved. Asking for "all the
+* cafes in this box" then only reads those few features from the shapefile, and asking for pubs instead
+* needs no new scan at all.
+*
+* The index is saved as '<shapefile name>.amenity.npz', and rebuilt whenever the shapefile's size or
+* modification time no longer match the ones it was built from.
+'''
+
+import os
+from collections import defaultdict
+
+import fiona
+import numpy
+from shapely.geometry import box, shape
+
+# bump this whenever the layout of the index file changes, so old indexes get rebuilt
+INDEX_VERSION = 1
+
+
+class AmenityIndex(object):
+    '''
+    * The features of one shapefile, grouped by amenity value
+    *
+    * The features tagged amenities[k] are fids[offsets[k]:offsets[k+1]], with bounding boxes (minX, minY,
+    * maxX, maxY) in the same rows of 'bounds'.
+    '''
+
+    def __init__(self, path, amenities, offsets, fids, bounds):
+        self.path = path
+        self.amenities = amenities
+        self.offsets = offsets
+        self.fids = fids
+        self.bounds = bounds
+        self._position = dict((value, k) for k, value in enumerate(amenities.tolist()))
+
+    def lookup(self, amenity, bbox=None):
+        '''
+        * Return the ids of the features tagged 'amenity' whose bounding boxes overlap 'bbox' (if given)
+        '''
+        k = self._position.get(amenity)
+        if k is None:
+            return numpy.array([], dtype=numpy.int64)
+        fids = self.fids[self.offsets[k]:self.offsets[k + 1]]
+        if bbox is not None:
+            b = self.bounds[self.offsets[k]:self.offsets[k + 1]]
+            fids = fids[(b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) & (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1])]
+        return fids
+
+    def read(self, amenity, bbox=None):
+        '''
+        * Yield the features tagged 'amenity' within 'bbox', reading only those features from the shapefile
+        *
+        * As with fiona's own bbox filter, a feature is kept if its geometry actually touches the box,
+        * not just its bounding box.
+        '''
+        area = box(*bbox) if bbox is not None else None
+        with fiona.open(self.path) as src:
+            for fid in self.lookup(amenity, bbox):
+                feat = src[int(fid)]
+                if area is None or shape(feat['geometry']).intersects(area):
+                    yield feat
+
+
+def sidecarPath(path):
+    return os.path.splitext(path)[0] + '.amenity.npz'
+
+
+def sourceStamp(path):
+    '''
+    * Return the sizes and modification times of the shapefile's geometry and attribute files
+    '''
+    stamp = []
+    for ext in ('.shp', '.dbf'):
+        stat = os.stat(os.path.splitext(path)[0] + ext)
+        stamp.extend([stat.st_size, stat.st_mtime])
+    return numpy.array(stamp + [INDEX_VERSION], dtype=numpy.float64)
+
+
+def buildAmenityIndex(path):
+    '''
+    * Scan a shapefile once, and save (and return) its AmenityIndex
+    '''
+    stamp = sourceStamp(path)
+    groups = defaultdict(list)
+    with fiona.open(path) as src:
+        for fid, feat in src.items():
+            value = feat['properties'].get('amenity')
+            if value and feat['geometry'] is not None:
+                groups[value].append((fid, shape(feat['geometry']).bounds))
+
+    amenities = sorted(groups)
+    offsets = numpy.zeros(len(amenities) + 1, dtype=numpy.int64)
+    fids, bounds = [], []
+    for k, value in enumerate(amenities):
+        fids.extend(fid for fid, b in groups[value])
+        bounds.extend(b for fid, b in groups[value])
+        offsets[k + 1] = len(fids)
+
+    index = AmenityIndex(path, numpy.array(amenities), offsets, numpy.array(fids, dtype=numpy.int64), numpy.array(bounds, dtype=numpy.float64).reshape(-1, 4))
+    numpy.savez(sidecarPath(path), stamp=stamp, amenities=index.amenities, offsets=index.offsets, fids=index.fids, bounds=index.bounds)
+    return index
+
+
+def openAmenityIndex(path):
+    '''
+    * Return the AmenityIndex of a shapefile, building it first if it is missing or out of date
+    '''
+    if os.path.exists(sidecarPath(path)):
+        # (the arrays are read out of the file before it is closed, so a long-running service doesn't leak a file per read)
+        with numpy.load(sidecarPath(path)) as saved:
+            if numpy.array_equal(saved['stamp'], sourceStamp(path)):
+                return AmenityIndex(path, saved['amenities'], saved['offsets'], saved['fids'], saved['bounds'])
+    return buildAmenityIndex(path)
+
+
+def readAmenity(path, amenity, bbox=None):
+    '''
+    * Yield the features of the shapefile at 'path' tagged 'amenity' within 'bbox', using its sidecar index
+    '''
+    return openAmenityIndex(path).read(amenity, bbox)
@@ -0,0 +1,384 @@
+'''
+* analysis.py
+*
+* The analysis part of the main script (Steps 2-5): which cafes can Jonny walk to within 30 minutes, and how?
+*
+* These steps only need fiona, pyproj, shapely, numpy and scipy, so they are kept apart from the map-making and the
+* 'extras' (the music and the image viewers), and can be run on their own, on a server or in a batch job, without
+* importing mapnik, PIL, pyglet or networkx at all (networkx is only imported to read the whole xml file, which the
+* streamed snapshot of the streets around the office never does). They write the same shapefiles as always:
+*
+*   shapefiles/cafes.shp, shapefiles/walk_bands.shp:    the cafes Jonny can walk to, and the 5/10/15/30 minute walk bands
+*   shapefiles/fav_routes.shp, shapefiles/fav_cafes.shp: my favourite cafes, and the routes to them
+*   shapefiles/cafe_routes.shp:                          how many of the routes to all of the cafes use each street
+*
+* The main script calls 'runAnalysis' and then draws the map. To run just the analysis (from this folder):
+*
+*   python analysis.py
+*   python analysis.py --no-cache --timings output/analysis_timings.json
+*
+* How long the imports take is measured too (it is in the timings, as 'import_s'), and 'benchmark.py' keeps track of
+* how long a fresh Python takes to import this module, and whether it pulled in any of the rendering libraries.
+'''
+
+import time
+importStarted = time.time()
+
+import argparse
+
+import fiona
+from pyproj import Geod
+from shapely.geometry import mapping, shape, LineString
+from amenityindex import readAmenity
+from cafestream import centroids, count, merge, writeShapefile
+from favourites import CafeLookup, loadFavourites
+from isochrones import bandPolygons, writeBands
+from osmstream import radiusBbox
+from stagecache import StageCache
+from steptimer import StepTimer
+from taskgraph import TaskGraph
+from walkgraph import buildSnapshot, changeFiles, loadGraph, snapshotRevision
+from walksearch import walkSearch
+
+# how long the imports above took, in seconds
+IMPORT_SECONDS = time.time() - importStarted
+
+# the OSM xml file of the street network
+XML_PATH = 'data/manchester.xml'
+
+# the walking distance radius around Jonny's office (2.5km, which takes 30 minutes by Naismith's rule, with no elevation accounted for)
+MAX_DIST = 2500
+
+# cafes further than this (in metres) from any street are reported and left out
+MAX_SNAP_DIST = 200
+
+# the walk-time bands (in minutes) that the walkable area is split into. The last band is the whole 30 minutes, as the walk search stops there
+BAND_MINUTES = [5, 10, 15, 30]
+
+# the libraries that only the map and the extras need, which importing this module must never pull in
+RENDERING_MODULES = ('mapnik', 'PIL', 'pyglet', 'networkx')
+
+
+def runAnalysis(timer=None, cache=None, tasks=None, waiting=None, debugShapefiles=False):
+    '''
+    * Run Steps 2-5, write their shapefiles, and return what the map needs from them
+    *
+    * 'timer' and 'cache' are the StepTimer and StageCache to use (by default, no timings, and the stages are cached in
+    * 'output/cache'). Any 'tasks' already added to a TaskGraph are run alongside the cafe filter and the snapshot build
+    * (the main script adds the map style and decorations), and their results are returned as 'results'. 'waiting' is
+    * called just before the walk search starts, if it has to be run (the main script plays some music). Set
+    * 'debugShapefiles' to also save the cafes from each file to 'shapefiles/cafe_polys.shp' and 'shapefiles/cafe_points.shp'.
+    '''
+    timer = timer if timer is not None else StepTimer(False)
+    cache = cache if cache is not None else StageCache('output/cache')
+    tasks = tasks if tasks is not None else TaskGraph()
+    changes = changeFiles()
+
+    # STEP 2:
+    # Get the geographical coordinates of Jonny's office from the OSM shapefile provided
+
+    timer.start('step 2: office location')
+    with fiona.open('data/jonnysoffice.shp') as GISHQ:
+        jonnysLocation = GISHQ[0]['geometry']['coordinates']
+
+    # STEP 3:
+    # Make a bounding box that captures the area ~30 minutes walk around Jonny's office
+    # Then, filter the OSM shapefiles to show the cafes within this radius
+    #
+    # I have assumed a very basic 2.5km "as the crow flies" radius, according to Naismith's rule (no elevation accounted for)
+    # I will narrow this down in Step 4
+
+    timer.start('step 3: bounding box and cafe filter')
+
+    # the walking speed that turns the bands into distances (2.5km in 30 minutes, by Naismith's rule)
+    walkSpeed = MAX_DIST / 30.0
+
+    # create an 'offset distance variable', which multiplies the max distance by sqrt(2), thus capturing the entire area of the bounding box
+    offsetDist = MAX_DIST * (2**0.5)
+
+    # use the Forward Vincenty method (on the Airy ellipsoid of the British National Grid) to get the edge points of the bounding box
+    g = Geod(ellps='airy')
+    blX, blY, bAz = g.fwd(jonnysLocation[0], jonnysLocation[1], 225, offsetDist)
+    trX, trY, bAz = g.fwd(jonnysLocation[0], jonnysLocation[1], 45, offsetDist)
+    bbox = (blX, blY, trX, trY)
+
+    # the walking graph only needs the streets that a walk of up to MAX_DIST could reach, from the node the office snaps to, plus the
+    # nodes that the cafes at the end of those walks snap to. So only the streets in a box around that (larger) circle are read from
+    # 'manchester.xml', as a regional or national OSM extract would never fit in memory as a whole graph
+    graphArea = radiusBbox(jonnysLocation[0], jonnysLocation[1], MAX_DIST + 2 * MAX_SNAP_DIST)
+
+    # note the coordinate reference system of the OSM shapefiles, so the results can be saved in the same one
+    with fiona.open('data/osm_points.shp') as point:
+        osmCrs = point.crs
+
+    ## before filtering, check whether the cafes have already been found from exactly the same data, settings and code (see 'stagecache.py').
+    ## if they have, the results of this step and Step 4 are simply read back in from last time. Rather than the xml file, the cafes depend on
+    ## the walking graph's 'revision', which only changes when the streets around the office do: so any new change files are applied to the
+    ## snapshot now (this only takes as long as the changes are big), and a change file that doesn't touch the area doesn't find the cafes again.
+    ## If there's no snapshot yet (or 'manchester.xml' itself has changed), it is built below, and the cafes are found again regardless
+    graphRevision = snapshotRevision(XML_PATH, None, graphArea, None, changes)
+    cafesInputs = ['data/jonnysoffice.shp', 'data/osm_polygons.shp', 'data/osm_points.shp', 'analysis.py',
+                   'amenityindex.py', 'cafestream.py', 'isochrones.py', 'osmchange.py', 'osmstream.py', 'walkgraph.py', 'walksearch.py']
+    cafesParams = {'maxDist': MAX_DIST, 'maxSnapDist': MAX_SNAP_DIST, 'bands': BAND_MINUTES, 'graph': graphRevision}
+    cafesKey = cache.key('cafes', cafesInputs, cafesParams)
+    cafesCached = graphRevision is not None and cache.fresh('cafes', cafesKey, ['shapefiles/cafes.shp', 'shapefiles/walk_bands.shp'])
+
+    if not cafesCached:
+        ## now, set up the chain of steps (see 'cafestream.py') that each cafe flows through, without being saved and re-opened on the way
+        # the 'osm_polygons' shapefile: pull out only the cafes within the bounding box, and convert each cafe from a polygon to its centroid
+        # point (doing this makes it easier to measure the distance between Jonny's office and these cafes, and it also makes it easier to
+        # 'draw' the cafes on the map using an icon). The cafes are found using a small index of each amenity type, saved next to the shapefile
+        # (see 'amenityindex.py'), so only the cafes themselves are read from the file
+        cafeCounts = {}
+        cafePolys = count(centroids(readAmenity('data/osm_polygons.shp', 'cafe', bbox)), cafeCounts, 'polygons')
+
+        # the 'osm_points' shapefile: do the same bounding box and filter calculations (these are already points)
+        cafePoints = count(readAmenity('data/osm_points.shp', 'cafe', bbox), cafeCounts, 'points')
+
+        # optionally, save the cafes from each file as they go past
+        if debugShapefiles:
+            cafePolys = writeShapefile(cafePolys, 'shapefiles/cafe_polys.shp', osmCrs)
+            cafePoints = writeShapefile(cafePoints, 'shapefiles/cafe_points.shp', osmCrs)
+
+    ## now, run the work that doesn't depend on anything else all at once (see 'taskgraph.py'), rather than one piece after another:
+    ## the cafe filter (on a thread, as it mostly waits for the shapefiles to be read), and building the walking graph snapshot for
+    ## Step 4 (in its own process, as parsing the xml keeps a processor busy), along with any tasks the caller has added
+    timer.start('steps 3-5: independent tasks')
+    if not cafesCached:
+        tasks.add('cafe filter', lambda: list(merge(cafePolys, cafePoints)))
+        tasks.add('walking graph', buildSnapshot, (XML_PATH, None, graphArea, None, changes), kind='process')
+    results = tasks.run()
+
+    # note how long each task took, and which chain of tasks everything else was waiting for
+    timer.attach('task graph', tasks.summary())
+    if results:
+        criticalPath, criticalTime = tasks.criticalPath()
+        print('...(ran %d tasks at the same time in %s seconds, waiting mostly for: %s)...' % (len(results), round(tasks.wall, 2), ' -> '.join(criticalPath)))
+
+    if not cafesCached and graphRevision is None:
+        # the walking graph's snapshot has only just been built, so now the cafes' key can be worked out from its revision
+        cafesParams['graph'] = results['walking graph']
+        cafesKey = cache.key('cafes', cafesInputs, cafesParams)
+
+    if not cafesCached:
+        # the cafe filter ran the chain, storing all the cafe nodes (from both files) in a single list for analysis in Step 4
+        cafeCoordinates = results['cafe filter']
+        timer.count('cafes from osm_polygons', cafeCounts['polygons'])
+        timer.count('cafes from osm_points', cafeCounts['points'])
+
+        # print the result (to test the outcome)
+        print("...there are %d cafes Jonny potentially can walk to in 30 minutes, from the 'osm_polygons' file..." % cafeCounts['polygons'])
+        print("...and %d cafes Jonny can potentially walk to in 30 minutes, from the 'osm_points' file..." % cafeCounts['points'])
+
+    # STEP 4:
+    # Calculate which of these cafes are actually within a 30 minute walk
+    #
+    # The bounding box is a rough measurement, designed to narrow down the cafes that I need to analyse in this step.
+    # Now, the distance between Jonny's office and each cafe will be measured. First, the shortest path between Jonny's
+    # office and each cafe will be calculated by loading a walking graph from 'manchester.xml', and then growing a single
+    # shortest-path tree (Dijkstra, see 'walksearch.py') out from the office. The length of every street in the graph is
+    # measured once, using the Inverse Vincenty method, when the graph is compiled, so the length of each cafe's path is
+    # simply looked up in that tree. If the total distance is less than 2.5km (which, according to Naismith's Rule, will
+    # take 30 minutes on a flat elevation), then it will be mapped. Otherwise, it will be discarded as Jonny cannot walk
+    # to it in 30 minutes.
+    #
+    # The same tree is also turned into walk-time bands (the areas within 5, 10, 15 and 30 minutes' walk, see 'isochrones.py'),
+    # which are drawn on the map. These are only for the map: which cafes Jonny can walk to is down to the length of their paths,
+    # and each one is labelled with the smallest band that its path fits in.
+
+    if cafesCached:
+        # read the cafes Jonny can walk to (and their nodes and walking distances) back in from last time. The walking graph and the
+        # walk tree aren't needed unless Step 5 has to be run again
+        saved = cache.load('cafes')
+        walkableCafes, walkableNodes, walkableDists, office = saved['cafes'], saved['nodes'], saved['dists'], saved['office']
+        graph = walkTree = None
+        print('...nothing has changed since last time, so there are still %d cafes that Jonny can ACTUALLY walk to within 30 minutes...' % len(walkableCafes))
+
+    else:
+        # print some context to inform the person who is running the code of the next step
+        print('...now, to figure out which ones are ACTUALLY <30 minutes walk. This can take a few seconds...')
+        if waiting is not None:
+            waiting()
+
+        ## now, calculate the distance from Jonny's office to each of these cafes
+        # load the walking graph. The first time, the walkable streets around the office are streamed out of 'manchester.xml' (see
+        # 'osmstream.py') and a compiled snapshot of them is saved next to it in 'data/manchester.<area>.graph' (this was done while
+        # the cafes were being filtered in Step 3, in another process), so the snapshot is opened instantly
+        timer.start('step 4: load walking graph')
+        graph = loadGraph(XML_PATH, None, graphArea, None, changes)
+        timer.count('graph nodes', len(graph.nodeIds))
+
+        # initialise list variables to store all the cafes that are <30 minutes walk, along with their nodes and walking distances
+        walkableCafes = []
+        walkableNodes = []
+        walkableDists = []
+
+        timer.start('step 4: walk search')
+
+        # set the 'from node' as the node nearest to Jonny's office, on the main street network if there is a node of it within MAX_SNAP_DIST
+        # (like the cafes, so the office is never snapped onto a little cut-off bit of footpath that can't reach anything)
+        office = graph.originNode(jonnysLocation[0], jonnysLocation[1], MAX_SNAP_DIST)
+        if office is None:
+            raise ValueError("Jonny's office is more than %d m from any street in the walking graph" % MAX_SNAP_DIST)
+
+        # note which connected part of the street network the office is on, so the cafes can be snapped onto that part too
+        officeComponent = graph.componentOf(office)
+
+        # run ONE walk search (Dijkstra) out from Jonny's office, which stops once it gets further than MAX_DIST away
+        # (this replaces a separate has_path and A* search per cafe, so it only costs as much as the walkable area)
+        walkTree = walkSearch(graph, office, MAX_DIST)
+        timer.count('nodes expanded', walkTree.expanded())
+
+        timer.start('step 4: cafe walking distances')
+
+        # to set the 'to nodes', snap all of the cafes in 'cafeCoordinates' to the graph in one go. Each one is snapped to the nearest node
+        # that is connected to the office (rather than to an isolated bit of footpath, which would make the cafe unreachable)
+        cafeNodes, snapDists = graph.snapNodes([i['geometry']['coordinates'] for i in cafeCoordinates], officeComponent, MAX_SNAP_DIST)
+
+        # let the person running the code know about any cafes that were too far from a street to be snapped
+        if None in cafeNodes:
+            print('...( %d cafes are more than %d m from any street, so have been left out)...' % (cafeNodes.count(None), MAX_SNAP_DIST))
+
+        # look up the length of every cafe's shortest path in the walk tree at once (infinite if the search never reached the cafe)
+        cafeDists = walkTree.distancesTo(cafeNodes)
+
+        timer.start('step 4: walk bands')
+
+        # turn the walk tree into the walk-time bands: for each band, the streets Jonny can walk along in that time, widened by how far
+        # a cafe can be from a street. The bands are only drawn on the map (they are saved for it, in the British National Grid): a cafe
+        # can be close to a street in a small band but only be reachable the long way round, so each cafe is labelled from its own path
+        bands = bandPolygons(walkTree, [minutes * walkSpeed for minutes in BAND_MINUTES], MAX_SNAP_DIST)
+        writeBands('shapefiles/walk_bands.shp', BAND_MINUTES, bands)
+
+        # now, loop through each of the cafes, their nodes and their distances...
+        walkableMinutes = []
+        for i, cafe, dist in zip(cafeCoordinates, cafeNodes, cafeDists):
+
+            # ...and if it was snapped to a street and its shortest path is less than MAX_DIST (so within 30 minutes' walk), store the
+            # cafe's coordinates in the 'walkableCafes' variable (the same test as 'batch.py', and as 'service.py' makes from the street)
+            if cafe is not None and dist < MAX_DIST:
+                walkableCafes.append(i)
+                walkableNodes.append(cafe)
+                walkableDists.append(float(dist))
+
+                # label it with the smallest band its path fits in
+                walkableMinutes.append([minutes for minutes in BAND_MINUTES if dist <= minutes * walkSpeed][0])
+        timer.count('cafes tested', len(cafeNodes))
+        timer.count('cafes walkable', len(walkableCafes))
+
+        ## finally, save the walkableCafe list to a point shapefile (noting the walk-time band each cafe is in)
+        with fiona.open('shapefiles/cafes.shp', 'w', driver='ESRI Shapefile', crs=osmCrs, schema={'geometry': 'Point', 'properties': {'minutes': 'int'}}) as dst:
+            for feat, minutes in zip(walkableCafes, walkableMinutes):
+                dst.write({'geometry': feat['geometry'], 'properties': {'minutes': minutes}})
+
+        # print the results
+        print('...calculated! There are %d cafes that Jonny can ACTUALLY walk to within 30 minutes. Now, to calculate the routes to my favourite cafes...' % len(walkableCafes))
+        for minutes in BAND_MINUTES:
+            print('...( %d of them in the %d minute band)...' % (walkableMinutes.count(minutes), minutes))
+
+        # remember the cafes Jonny can walk to, for next time (as plain GeoJSON-like features)
+        cache.save('cafes', cafesKey, {'cafes': [{'geometry': mapping(shape(i['geometry'])), 'properties': dict(i['properties'])} for i in walkableCafes],
+                                       'nodes': walkableNodes, 'dists': walkableDists, 'office': office})
+
+    # STEP 5:
+    # Calculate the routes between Jonny's office and my favourite cafes (Anchor, Grindsmith and Takk),
+    # and store them as a shapefile so they can be mapped.
+    #
+    # My favourites are listed in the 'favourites.json' config file (by OSM id, name or coordinates), and are looked up
+    # among the cafes Jonny can walk to (see 'favourites.py'). As every route starts at Jonny's office, they can all simply
+    # be pulled out of the shortest-path tree that was grown in Step 4, without any more searching. The coordinates of
+    # the nodes in each route are then stored as a fiona linestring, and all of the routes are saved into a single
+    # shapefile. This will allow the routes to be mapped on my map.
+    #
+    # The same tree also shows which streets Jonny would use most on the way to ALL of the cafes he can walk to: the routes
+    # to every cafe are counted up street by street, and each street is saved once, with its count, so the busiest streets
+    # can be drawn thicker on the map.
+
+    # check whether the routes have already been found for the same favourites and cafes (see 'stagecache.py')
+    routesKey = cache.key('routes', ['favourites.json', 'favourites.py', 'walksearch.py', 'analysis.py'], after=[cafesKey])
+    if cache.fresh('routes', routesKey, ['shapefiles/fav_routes.shp', 'shapefiles/fav_cafes.shp', 'shapefiles/cafe_routes.shp']):
+        print("...my favourite cafes and the routes to them haven't changed either...")
+
+    else:
+        timer.start('step 5: favourite routes')
+
+        # the routes are pulled out of the walk tree from Step 4, so if the cafes were read back in from last time, grow the tree again
+        if walkTree is None:
+            graph = loadGraph(XML_PATH, None, graphArea, None, changes)
+            walkTree = walkSearch(graph, office, MAX_DIST)
+
+        # read my favourite cafes from the config file
+        favourites = loadFavourites('favourites.json')
+
+        # make an index of the cafes Jonny can walk to, so each favourite can be found by its OSM id, name or coordinates
+        cafeLookup = CafeLookup(walkableCafes)
+
+        # initialise lists to store the favourite cafes and the routes to them
+        favCafes = []
+        favRoutes = []
+
+        # look up each favourite...
+        for fav in favourites:
+            k = cafeLookup.find(fav)
+            if k is None:
+                print("... %s isn't one of the cafes Jonny can walk to, so it will be left off the map..." % fav['label'])
+                continue
+
+            # ...store the cafe (labelled with its name)...
+            favCafes.append({'geometry': walkableCafes[k]['geometry'], 'properties': {'name': fav['label']}})
+
+            # ...and pull its route out of the walk tree, pulling the coordinates of each node in the route from the walking graph
+            path = walkTree.pathTo(walkableNodes[k])
+            if len(path) > 1:
+                favRoutes.append({'geometry': mapping(LineString(graph.lineCoordinates(path))), 'properties': {'name': fav['label'], 'walk_dist': walkableDists[k]}})
+
+        timer.count('routes', len(favRoutes))
+
+        # write all of the routes to a single shapefile
+        with fiona.open('shapefiles/fav_routes.shp', 'w', driver='ESRI Shapefile', crs=osmCrs, schema={'geometry': 'LineString', 'properties': {'name': 'str', 'walk_dist': 'float'}}) as o:
+            for route in favRoutes:
+                o.write(route)
+
+        # write the favourite cafes to a shapefile (for styling their icons)
+        with fiona.open('shapefiles/fav_cafes.shp', 'w', driver='ESRI Shapefile', crs=osmCrs, schema={'geometry': 'Point', 'properties': {'name': 'str'}}) as dst:
+            for feat in favCafes:
+                dst.write(feat)
+
+        ## now, count how many of the routes to all of the cafes Jonny can walk to use each street. These are added up straight from the walk
+        ## tree (see 'walksearch.py'), without pulling out any of the routes themselves, so this stays quick with thousands of cafes
+        routeStreets = walkTree.routeStreets(walkableNodes)
+        timer.count('streets on routes', len(routeStreets))
+
+        # write each street (as a line between its two nodes) and its number of routes to a single shapefile
+        with fiona.open('shapefiles/cafe_routes.shp', 'w', driver='ESRI Shapefile', crs=osmCrs, schema={'geometry': 'LineString', 'properties': {'routes': 'int'}}) as o:
+            for fromNode, toNode, routes in routeStreets:
+                o.write({'geometry': mapping(LineString(graph.lineCoordinates([fromNode, toNode]))), 'properties': {'routes': routes}})
+
+        # remember that the routes have been found with these inputs
+        cache.save('routes', routesKey)
+
+    timer.stop()
+    return {'cafes': walkableCafes, 'nodes': walkableNodes, 'dists': walkableDists, 'office': office,
+            'cafesKey': cafesKey, 'routesKey': routesKey, 'changes': changes, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the cafes Jonny can walk to within 30 minutes, and the routes to them, without drawing the map.')
+    parser.add_argument('--no-cache', action='store_true', help='run every step, even if its inputs have not changed since last time')
+    parser.add_argument('--timings', default='output/analysis_timings.json', help='the file to write the timings of each step to')
+    parser.add_argument('--profile', action='store_true', help='also save a cProfile dump of the run, next to the timings')
+    args = parser.parse_args()
+
+    timer = StepTimer(True, args.profile)
+    timer.attach('import_s', round(IMPORT_SECONDS, 4))
+    print('...(imported the analysis in %.2f seconds)...' % IMPORT_SECONDS)
+
+    started = time.time()
+    analysis = runAnalysis(timer, StageCache('output/cache', not args.no_cache))
+    timer.report(args.timings, args.timings.rsplit('.', 1)[0] + '.pstats')
+    print('Found %d cafes Jonny can walk to in %.2f seconds (the shapefiles are in shapefiles/, and the timings in %s)' %
+          (len(analysis['cafes']), time.time() - started, args.timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+'''
+* batch.py
+*
+* Find the cafes within walking distance of MANY origins (offices, homes...) in one go.
+*
+* The walking graph is loaded once, and all the cafes around all of the origins are pulled out of the OSM
+* shapefiles and snapped onto it once. The walk search from each origin (see 'walksearch.py') is then handed
+* out to a pool of worker processes. Each worker opens the same memory-mapped graph snapshot (see
+* 'walkgraph.py'), so the graph is shared read-only between them rather than copied. The results for every
+* origin are written to a single CSV table, with an 'origin_id' column saying which origin each row is for.
+*
+* Usage (from this folder, like the main script):
+*
+*   python batch.py origins.shp walkable_cafes.csv --id-field name
+*   python batch.py origins.csv walkable_cafes.csv --processes 8
+*
+* A CSV file of origins needs 'id', 'lon' and 'lat' columns.
+'''
+
+import argparse, csv, os, sys
+from multiprocessing import Pool, cpu_count
+
+import fiona
+import numpy
+from pyproj import Geod
+
+from amenityindex import readAmenity
+from cafestream import centroids, merge
+from walkgraph import changeFiles, loadGraph
+from walksearch import walkSearch
+
+# the graph and snapped cafes that each worker process searches, set up once per process by 'initWorker'
+_shared = {}
+
+
+def readOrigins(path, idField=None):
+    '''
+    * Return a list of (origin id, (lon, lat)) from a point shapefile or a CSV file
+    '''
+    origins = []
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                origins.append((row['id'], (float(row['lon']), float(row['lat']))))
+    else:
+        with fiona.open(path) as src:
+            for fid, feat in src.items():
+                originId = feat['properties'][idField] if idField else fid
+                origins.append((originId, tuple(feat['geometry']['coordinates'][:2])))
+    return origins
+
+
+def searchArea(origins, maxDist):
+    '''
+    * Return the bounding box that covers the Step 3 'as the crow flies' box of every origin
+    '''
+    g = Geod(ellps='airy')
+    offsetDist = maxDist * (2**0.5)
+    lons = numpy.array([lonlat[0] for originId, lonlat in origins])
+    lats = numpy.array([lonlat[1] for originId, lonlat in origins])
+    blX, blY, bAz = g.fwd(lons, lats, numpy.full(len(origins), 225.0), numpy.full(len(origins), offsetDist))
+    trX, trY, bAz = g.fwd(lons, lats, numpy.full(len(origins), 45.0), numpy.full(len(origins), offsetDist))
+    return (float(numpy.min(blX)), float(numpy.min(blY)), float(numpy.max(trX)), float(numpy.max(trY)))
+
+
+def initWorker(xmlPath, graphArea, changes, maxDist, cafePositions):
+    '''
+    * Set up a worker process: open the (memory-mapped) graph snapshot and keep hold of the snapped cafes
+    '''
+    _shared['graph'] = loadGraph(xmlPath, None, graphArea, None, changes)
+    _shared['maxDist'] = maxDist
+    _shared['cafePositions'] = cafePositions
+
+
+def searchOrigin(task):
+    '''
+    * Run one walk search, and return (row, positions of the walkable cafes, their walking distances)
+    *
+    * 'task' is (row, origin node, origin component); cafes are looked up by the component they were
+    * snapped onto, so each origin only sees cafes snapped onto its own part of the street network.
+    '''
+    row, node, component = task
+    graph, maxDist = _shared['graph'], _shared['maxDist']
+    positions = _shared['cafePositions'][component]
+
+    tree = walkSearch(graph, node, maxDist)
+    dists = numpy.full(len(positions), numpy.inf)
+    snapped = positions >= 0
+    dists[snapped] = tree.dist[positions[snapped]]
+    walkable = numpy.nonzero(dists < maxDist)[0]
+    return row, walkable, dists[walkable]
+
+
+def runBatch(origins, xmlPath='data/manchester.xml', polygons='data/osm_polygons.shp', points='data/osm_points.shp', maxDist=2500, maxSnapDist=200, processes=None, changes=None):
+    '''
+    * Find the walkable cafes for every origin, and return (cafes, results)
+    *
+    * 'cafes' is the list of cafe features that were considered, and 'results' has one (origin id, cafe
+    * number, walking distance) tuple per walkable cafe per origin. The OSM 'changes' files are applied to
+    * the graph first (by default, the same ones as the main script; see 'walkgraph.changeFiles').
+    '''
+    changes = changeFiles() if changes is None else changes
+
+    # like the main script, the graph only needs the streets around the origins that a walk could reach, from the node each one
+    # snaps to (its snapshot is streamed out of the xml the first time, and shared with the workers)
+    graphArea = searchArea(origins, maxDist + 2 * maxSnapDist)
+    graph = loadGraph(xmlPath, None, graphArea, None, changes)
+
+    # pull out every cafe around any of the origins, once
+    bbox = searchArea(origins, maxDist)
+    cafes = list(merge(centroids(readAmenity(polygons, 'cafe', bbox)), readAmenity(points, 'cafe', bbox)))
+    cafeCoords = [cafe['geometry']['coordinates'] for cafe in cafes]
+
+    # snap the origins to the graph, and then the cafes onto each part of the network that an origin is on
+    originNodes, originSnapDists = graph.snapOrigins([lonlat for originId, lonlat in origins], maxSnapDist)
+
+    # let the person running the code know about any origins that were too far from a street to be snapped (they get no rows)
+    if None in originNodes:
+        print('...( %d origins are more than %d m from any street, so have been left out)...' % (originNodes.count(None), maxSnapDist))
+    tasks, cafePositions = [], {}
+    for row, node in enumerate(originNodes):
+        if node is None:
+            continue
+        component = graph.componentOf(node)
+        if component not in cafePositions:
+            nodes, dists = graph.snapNodes(cafeCoords, component, maxSnapDist)
+            cafePositions[component] = numpy.array([graph.index(n) if n is not None else -1 for n in nodes], dtype=numpy.int64)
+        tasks.append((row, node, component))
+
+    # fan the searches out over the worker processes (or just run them here, if there is only one)
+    if processes == 1:
+        initWorker(xmlPath, graphArea, changes, maxDist, cafePositions)
+        found = [searchOrigin(task) for task in tasks]
+    else:
+        workers = processes or cpu_count()
+        pool = Pool(workers, initializer=initWorker, initargs=(xmlPath, graphArea, changes, maxDist, cafePositions))
+        try:
+            found = pool.map(searchOrigin, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+        finally:
+            pool.close()
+            pool.join()
+
+    results = []
+    for row, walkable, dists in found:
+        for cafe, dist in zip(walkable, dists):
+            results.append((origins[row][0], int(cafe), float(dist)))
+    return cafes, results
+
+
+def writeResults(path, cafes, results):
+    '''
+    * Write the combined results table to a CSV file
+    '''
+    with open(path, 'wb' if sys.version_info[0] < 3 else 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['origin_id', 'cafe_osm_id', 'cafe_name', 'cafe_lon', 'cafe_lat', 'walk_dist'])
+        for originId, cafe, dist in results:
+            props = cafes[cafe]['properties']
+            lon, lat = cafes[cafe]['geometry']['coordinates'][:2]
+            writer.writerow([originId, props.get('osm_id', ''), props.get('name', '') or '', lon, lat, round(dist, 1)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the cafes within walking distance of many origins at once.')
+    parser.add_argument('origins', help="a point shapefile, or a CSV file with 'id', 'lon' and 'lat' columns")
+    parser.add_argument('output', help='the CSV file to write the combined results to')
+    parser.add_argument('--id-field', help='the shapefile attribute to use as the origin id (default: the feature id)')
+    parser.add_argument('--max-dist', type=float, default=2500, help='the walking distance limit, in metres (default: 2500)')
+    parser.add_argument('--max-snap-dist', type=float, default=200, help='leave out cafes further than this from any street, in metres (default: 200)')
+    parser.add_argument('--processes', type=int, help='the number of worker processes (default: one per core)')
+    parser.add_argument('--graph', default='data/manchester.xml', help='the OSM xml file of the street network')
+    parser.add_argument('--polygons', default='data/osm_polygons.shp', help='the OSM polygons shapefile')
+    parser.add_argument('--points', default='data/osm_points.shp', help='the OSM points shapefile')
+    args = parser.parse_args()
+
+    origins = readOrigins(args.origins, args.id_field)
+    cafes, results = runBatch(origins, args.graph, args.polygons, args.points, args.max_dist, args.max_snap_dist, args.processes)
+    writeResults(args.output, cafes, results)
+    print('%d origins, %d walkable origin-cafe pairs, written to %s' % (len(origins), len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+'''
+* benchmark.py
+*
+* Measure how the analysis scales, using made-up street networks and cafes of different sizes.
+*
+* For each size, a square grid of streets (in the same OSM xml format as 'manchester.xml', so it goes through
+* Jonny's osm2nx code like the real thing) is generated, along with OSM point, polygon and line shapefiles that
+* have a set number of cafes (and other amenities, to filter out) scattered over it. Everything is made from a
+* fixed random seed, so the same size always gives the same data, and nothing needs downloading. Each stage of
+* the analysis is then timed (see 'steptimer.py'):
+*
+*   import analysis:        a fresh Python importing 'analysis.py' (Steps 2-5 of the main script, without the map), as a batch job
+*                           would, counting any rendering libraries (mapnik, PIL, pyglet, networkx) it pulled in (there should be none)
+*   graph load (xml):       reading the xml with osm2nx and compiling the graph snapshot (see 'walkgraph.py')
+*   graph load (snapshot):  opening the snapshot again
+*   cafe filter:            pulling the cafes out of the shapefiles (see 'amenityindex.py' and 'cafestream.py')
+*   snapping:               snapping the cafes onto the street network
+*   walk search:            the walk search from the 'office' in the middle (see 'walksearch.py')
+*   path lengths:           looking up every cafe's walking distance, and the route to each walkable one
+*   prepare layers, render: clipping the background layers and rendering them (only if mapnik is installed)
+*
+* The results are saved as a JSON 'baseline' file, which a later run can be compared against to spot slowdowns (and
+* any change in what a stage counts, such as a rendering library being imported).
+* Usage (from this folder):
+*
+*   python benchmark.py --sizes small medium large --out output/benchmark.json
+*   python benchmark.py --sizes small medium large --compare output/benchmark.json
+*
+* The generated data is kept in 'output/benchmark/<size>', and only generated again if it is missing.
+'''
+
+import argparse, json, math, os, platform, random, shutil, subprocess, sys
+
+import fiona
+from fiona.crs import from_epsg
+from pyproj import Proj, transform
+from shapely.geometry import Point, box, mapping
+
+from amenityindex import readAmenity
+from cafestream import centroids, merge
+from steptimer import StepTimer
+from walkgraph import loadGraph
+from walksearch import walkSearch
+
+# bump this whenever the generated data or the stages change, as results from different versions can't be compared
+BENCHMARK_VERSION = 2
+
+# (streets along each side of the grid, number of cafes) for each size. With streets 80m apart, 'small' is a
+# neighbourhood (1.5km across), and 'city' is about the size of Greater Manchester's built-up area (32km across)
+SIZES = {
+    'small': (20, 50),
+    'medium': (60, 300),
+    'large': (150, 1500),
+    'city': (400, 8000),
+}
+
+# the middle of the grid (Jonny's office), the distance between streets, and the walking distance limit (in metres)
+CENTRE = (-2.2446, 53.4808)
+SPACING = 80
+MAX_DIST = 2500
+MAX_SNAP_DIST = 200
+
+# the other amenities scattered among the cafes (two of each for every cafe), which the cafe filter has to skip
+DECOYS = ('pub', 'restaurant', 'bank')
+
+# the mean radius of the Earth in metres, used to space the grid out in degrees
+EARTH_RADIUS = 6371008.8
+
+
+def gridLonLat(n):
+    '''
+    * Return functions turning grid positions (0 to n-1, or anywhere between) into longitude and latitude
+    '''
+    dLat = math.degrees(SPACING / EARTH_RADIUS)
+    dLon = dLat / math.cos(math.radians(CENTRE[1]))
+    return (lambda i: CENTRE[0] + (i - (n - 1) / 2.0) * dLon), (lambda j: CENTRE[1] + (j - (n - 1) / 2.0) * dLat)
+
+
+def writeOsm(path, n, seed=1):
+    '''
+    * Write an n x n grid of streets as an OSM xml file
+    *
+    * Every row and column of the grid is a 'residential' way (every tenth one a 'primary' road), and the nodes
+    * are nudged slightly off the grid so the streets are not all exactly the same length.
+    '''
+    rand = random.Random(seed)
+    toLon, toLat = gridLonLat(n)
+    nodeId = lambda i, j: 1 + i * n + j
+    with open(path, 'w') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version='0.6' generator='benchmark.py'>\n")
+        for i in range(n):
+            for j in range(n):
+                f.write("  <node id='%d' lat='%.7f' lon='%.7f' version='1'/>\n" % (nodeId(i, j), toLat(j + rand.uniform(-0.1, 0.1)), toLon(i + rand.uniform(-0.1, 0.1))))
+        wayId = 1
+        for line in range(n):
+            for nodes in ([nodeId(line, j) for j in range(n)], [nodeId(i, line) for i in range(n)]):
+                f.write("  <way id='%d' version='1'>\n" % wayId)
+                for node in nodes:
+                    f.write("    <nd ref='%d'/>\n" % node)
+                f.write("    <tag k='highway' v='%s'/>\n  </way>\n" % ('primary' if line % 10 == 0 else 'residential'))
+                wayId += 1
+        f.write('</osm>\n')
+
+
+def writeShapefiles(folder, n, cafes, seed=1):
+    '''
+    * Write the OSM point, polygon and line shapefiles for an n x n grid, with 'cafes' cafes scattered over it
+    *
+    * Half of the cafes (and decoy amenities) are points, and half are small square buildings.
+    '''
+    rand = random.Random(seed)
+    toLon, toLat = gridLonLat(n)
+    crs = from_epsg(4326)
+    size = 0.15
+
+    amenities = []
+    for k in range(cafes):
+        amenities.append('cafe')
+        amenities.extend(DECOYS[:2] if k % 2 else DECOYS[1:])
+    rand.shuffle(amenities)
+
+    pointSchema = {'geometry': 'Point', 'properties': {'osm_id': 'str', 'amenity': 'str', 'name': 'str'}}
+    polygonSchema = {'geometry': 'Polygon', 'properties': {'osm_id': 'str', 'amenity': 'str', 'name': 'str', 'building': 'str'}}
+    with fiona.open(os.path.join(folder, 'osm_points.shp'), 'w', driver='ESRI Shapefile', crs=crs, schema=pointSchema) as points:
+        with fiona.open(os.path.join(folder, 'osm_polygons.shp'), 'w', driver='ESRI Shapefile', crs=crs, schema=polygonSchema) as polygons:
+            for k, amenity in enumerate(amenities):
+                i, j = rand.uniform(0, n - 1), rand.uniform(0, n - 1)
+                props = {'osm_id': str(k + 1), 'amenity': amenity, 'name': '%s %d' % (amenity, k + 1)}
+                if k % 2:
+                    points.write({'geometry': mapping(Point(toLon(i), toLat(j))), 'properties': props})
+                else:
+                    props['building'] = 'yes'
+                    square = box(toLon(i - size), toLat(j - size), toLon(i + size), toLat(j + size))
+                    polygons.write({'geometry': mapping(square), 'properties': props})
+
+    lineSchema = {'geometry': 'LineString', 'properties': {'highway': 'str', 'waterway': 'str', 'railway': 'str'}}
+    with fiona.open(os.path.join(folder, 'osm_lines.shp'), 'w', driver='ESRI Shapefile', crs=crs, schema=lineSchema) as lines:
+        for line in range(n):
+            highway = 'primary' if line % 10 == 0 else 'residential'
+            for coords in ([(toLon(line), toLat(0)), (toLon(line), toLat(n - 1))], [(toLon(0), toLat(line)), (toLon(n - 1), toLat(line))]):
+                lines.write({'geometry': {'type': 'LineString', 'coordinates': coords}, 'properties': {'highway': highway, 'waterway': '', 'railway': ''}})
+
+
+def makeDataset(folder, n, cafes):
+    '''
+    * Generate the data for one size in 'folder' (laid out like this folder: 'data/manchester.xml' and so on), if it is not there yet
+    '''
+    data = os.path.join(folder, 'data')
+    stampPath = os.path.join(data, 'benchmark.json')
+    stamp = {'version': BENCHMARK_VERSION, 'streets': n, 'cafes': cafes}
+    if os.path.exists(stampPath):
+        with open(stampPath) as f:
+            if json.load(f) == stamp:
+                return
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(data)
+    writeOsm(os.path.join(data, 'manchester.xml'), n)
+    writeShapefiles(data, n, cafes)
+    with open(stampPath, 'w') as f:
+        json.dump(stamp, f)
+
+
+def renderStages(folder, timer, extent):
+    '''
+    * Prepare and render the background layers of the map over 'extent' (skipped if mapnik is not installed)
+    '''
+    try:
+        import mapnik
+    except ImportError:
+        return
+    from mapimage import toPil
+    from mapstyle import compileSpec
+    from renderdata import prepareLayers
+
+    timer.start('prepare layers')
+    prepareLayers([os.path.join(folder, 'data', 'osm_polygons.shp'), os.path.join(folder, 'data', 'osm_lines.shp')], extent, os.path.join(folder, 'output', 'render'))
+
+    # only the background layers are drawn, as the icons and routes are not part of the generated data
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mapstyle.json')) as f:
+        spec = json.load(f)
+    spec['layers'] = [layer for layer in spec['layers'] if layer['name'].startswith('Manc_')]
+    used = set(name for layer in spec['layers'] for name in layer['styles'])
+    spec['styles'] = dict((name, rules) for name, rules in spec['styles'].items() if name in used)
+    m = mapnik.Map(1600, 1600)
+    mapnik.load_map_from_string(m, compileSpec(spec), False, os.path.abspath(folder))
+
+    timer.start('render')
+    m.zoom_to_box(mapnik.Box2d(*extent))
+    image = mapnik.Image(m.width, m.height)
+    mapnik.render(m, image)
+    toPil(image).save(os.path.join(folder, 'output', 'render.png'), 'PNG')
+
+
+def importAnalysis(timer):
+    '''
+    * Time a fresh Python importing 'analysis.py', and count the rendering libraries that came with it
+    '''
+    timer.start('import analysis')
+    code = 'import json, sys, analysis; print(json.dumps([name for name in analysis.RENDERING_MODULES if name in sys.modules]))'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    timer.count('rendering modules imported', len(json.loads(output.decode('utf-8').strip().splitlines()[-1])))
+
+
+def runOnce(folder, timer):
+    '''
+    * Time each stage of the analysis once, on the data in 'folder'
+    '''
+    importAnalysis(timer)
+
+    data = os.path.join(folder, 'data')
+    xmlPath = os.path.join(data, 'manchester.xml')
+
+    timer.start('graph load (xml)')
+    cacheDir = os.path.join(data, 'manchester.graph')
+    if os.path.isdir(cacheDir):
+        shutil.rmtree(cacheDir)
+    graph = loadGraph(xmlPath)
+    timer.count('nodes', len(graph))
+    timer.count('edges', len(graph.indices))
+
+    timer.start('graph load (snapshot)')
+    graph = loadGraph(xmlPath)
+
+    # the same 'as the crow flies' box around the office as Step 3 of the main script
+    timer.start('cafe filter')
+    offset = math.degrees(MAX_DIST / EARTH_RADIUS)
+    bbox = (CENTRE[0] - offset / math.cos(math.radians(CENTRE[1])), CENTRE[1] - offset, CENTRE[0] + offset / math.cos(math.radians(CENTRE[1])), CENTRE[1] + offset)
+    cafes = list(merge(centroids(readAmenity(os.path.join(data, 'osm_polygons.shp'), 'cafe', bbox)), readAmenity(os.path.join(data, 'osm_points.shp'), 'cafe', bbox)))
+    timer.count('cafes found', len(cafes))
+
+    timer.start('snapping')
+    office = graph.originNode(CENTRE[0], CENTRE[1], MAX_SNAP_DIST)
+    if office is None:
+        raise ValueError('the centre of the benchmark is more than %d m from any street in the walking graph' % MAX_SNAP_DIST)
+    cafeNodes, snapDists = graph.snapNodes([cafe['geometry']['coordinates'] for cafe in cafes], graph.componentOf(office), MAX_SNAP_DIST)
+    timer.count('cafes snapped', len(cafeNodes) - cafeNodes.count(None))
+
+    timer.start('walk search')
+    tree = walkSearch(graph, office, MAX_DIST)
+    timer.count('nodes expanded', tree.expanded())
+
+    timer.start('path lengths')
+    dists = tree.distancesTo(cafeNodes)
+    for node, dist in zip(cafeNodes, dists):
+        if dist < MAX_DIST:
+            graph.lineCoordinates(tree.pathTo(node))
+            timer.count('routes')
+
+    # render the area the walk search covered (in British National Grid metres, like the main script's map)
+    x, y = transform(Proj(init='epsg:4326'), Proj(init='epsg:27700'), CENTRE[0], CENTRE[1])
+    renderStages(folder, timer, (x - MAX_DIST, y - MAX_DIST, x + MAX_DIST, y + MAX_DIST))
+    timer.stop()
+
+
+def runSize(name, repeats=3, root='output/benchmark'):
+    '''
+    * Generate the data for one size, and return its timings (the fastest of 'repeats' runs for each stage)
+    '''
+    n, cafes = SIZES[name]
+    folder = os.path.join(root, name)
+    makeDataset(folder, n, cafes)
+
+    best = []
+    for repeat in range(repeats):
+        timer = StepTimer()
+        runOnce(folder, timer)
+        if not best:
+            best = timer.steps
+        else:
+            for kept, step in zip(best, timer.steps):
+                if step['wall_s'] < kept['wall_s']:
+                    kept.update(wall_s=step['wall_s'], cpu_s=step['cpu_s'])
+                kept['peak_rss_mb'] = max(kept['peak_rss_mb'], step['peak_rss_mb'])
+    return {'streets': n, 'cafes': cafes, 'repeats': repeats, 'steps': best}
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    * Print how each stage compares with a baseline, and return the stages that got slower than 'tolerance' allows, or
+    * whose counts changed
+    *
+    * The data is made from the same seed every time, so the counts (nodes expanded, cafes found, rendering modules
+    * imported...) should never change: if one does, the analysis is doing different work than it used to.
+    '''
+    slower = []
+    for name in sorted(results['sizes']):
+        old = baseline.get('sizes', {}).get(name)
+        if old is None:
+            continue
+        oldSteps = dict((step['name'], step) for step in old['steps'])
+        for step in results['sizes'][name]['steps']:
+            if step['name'] not in oldSteps:
+                continue
+            before, after = oldSteps[step['name']]['wall_s'], step['wall_s']
+            ratio = after / before if before > 0 else 1.0
+
+            # stages that take under a millisecond are too noisy to call slower
+            regressed = ratio > 1 + tolerance and after - before > 0.001
+            print('%-7s %-22s %9.4fs -> %9.4fs  (x%.2f)%s' % (name, step['name'], before, after, ratio, '  SLOWER' if regressed else ''))
+            if regressed:
+                slower.append((name, step['name'], 'x%.2f' % ratio))
+
+            oldCounts, counts = oldSteps[step['name']].get('counts', {}), step.get('counts', {})
+            for key in sorted(set(oldCounts) | set(counts)):
+                if oldCounts.get(key) != counts.get(key):
+                    print('%-7s %-22s   %s: %s -> %s  CHANGED' % (name, step['name'], key, oldCounts.get(key), counts.get(key)))
+                    slower.append((name, step['name'], key))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of the analysis on made-up data of different sizes.')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES, key=lambda name: SIZES[name]), default=['small', 'medium', 'large'])
+    parser.add_argument('--repeats', type=int, default=3, help='run each size this many times, and keep the fastest time for each stage (default: 3)')
+    parser.add_argument('--out', default='output/benchmark.json', help='the file to save the results to, as a new baseline')
+    parser.add_argument('--compare', help='a baseline file from an earlier run, to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much slower (as a fraction) a stage can get before it counts as slower (default: 0.25)')
+    args = parser.parse_args()
+
+    # read the baseline first, as it may well be the file the new results are about to be saved over
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != BENCHMARK_VERSION:
+            sys.exit('%s was made by a different version of the benchmark, so cannot be compared' % args.compare)
+
+    results = {'version': BENCHMARK_VERSION, 'python': platform.python_version(), 'platform': platform.platform(), 'sizes': {}}
+    for name in args.sizes:
+        results['sizes'][name] = runSize(name, args.repeats)
+        for step in results['sizes'][name]['steps']:
+            print('%-7s %-22s %9.4fs' % (name, step['name'], step['wall_s']))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Saved the results to %s' % args.out)
+
+    if baseline is not None:
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            sys.exit('%d stages got slower, or changed what they count' % len(slower))
+
+
+if __name__ == '__main__':
+    main()
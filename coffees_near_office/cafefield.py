@@ -0,0 +1,201 @@
+'''
+* cafefield.py
+*
+* How far is it to the nearest cafe, from every street in the city? (The reverse of the main script's question.)
+*
+* Asking that of each street node in turn would take one search per node. Instead, ONE Dijkstra search is grown
+* from every cafe at once (a 'multi-source' search), so each node ends up labelled with its nearest cafe and the
+* walking distance to it, in about the time a single search from the office takes. The labels are saved as two
+* small arrays (a 4-byte distance and a 4-byte cafe number for each node), and can be turned into a heatmap for
+* the map: a PNG in the British National Grid, with a world file so mapnik can place it ('mapstyle.json' draws it
+* under the walk bands, if it is there). The parts of the city badly served by cafes show up in red.
+*
+* To label the whole street network, and draw a heatmap of central Manchester, from this folder:
+*
+*   python cafefield.py --raster 381000 395000 387000 401000
+'''
+
+import argparse
+
+import numpy
+from PIL import Image
+from pyproj import transform
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from amenityindex import readAmenity
+from cafestream import centroids, merge
+from osmstream import WALKABLE
+from renderdata import bng, wgs84
+from walkgraph import loadGraph
+
+# the colours of the heatmap, at walking distances (in metres) to the nearest cafe of 0, 5, 10, 15 and 30 minutes (and beyond)
+RAMP = ((0, (26, 152, 80)), (417, (145, 207, 96)), (833, (254, 224, 139)), (1250, (252, 141, 89)), (2500, (215, 48, 39)))
+
+# how opaque the heatmap is (out of 255), where there are streets
+OPACITY = 170
+
+
+def findCafes(polygons='data/osm_polygons.shp', points='data/osm_points.shp'):
+    '''
+    * Return the (lon, lat) of every cafe in both OSM shapefiles (cafes drawn as buildings are turned into their centroids)
+    '''
+    cafes = merge(centroids(readAmenity(polygons, 'cafe')), readAmenity(points, 'cafe'))
+    return [tuple(cafe['geometry']['coordinates'][:2]) for cafe in cafes]
+
+
+def nearestCafes(graph, cafeNodes, limit=numpy.inf):
+    '''
+    * Label every node of a WalkGraph with the walking distance to its nearest cafe, and which cafe that is
+    *
+    * 'cafeNodes' holds the node each cafe was snapped to (or None). Returns a float32 array of distances in metres,
+    * and an int32 array of positions in 'cafeNodes' (infinity and -1 for nodes no cafe can be reached from).
+    '''
+    snapped = [k for k, node in enumerate(cafeNodes) if node is not None]
+    sources = numpy.array([graph.index(cafeNodes[k]) for k in snapped], dtype=numpy.int64)
+    dist = numpy.full(len(graph), numpy.inf, dtype=numpy.float32)
+    nearest = numpy.full(len(graph), -1, dtype=numpy.int32)
+    if not len(sources):
+        return dist, nearest
+
+    # several cafes can share a node, so note the first cafe at each one
+    unique, first = numpy.unique(sources, return_index=True)
+    cafeAt = numpy.full(len(graph), -1, dtype=numpy.int32)
+    cafeAt[unique] = numpy.array(snapped, dtype=numpy.int32)[first]
+
+    try:
+        # scipy 1.3 and later can grow one search from all of the sources, and note which one reached each node first
+        found, pred, origin = dijkstra(graph.matrix(), directed=True, indices=unique, limit=limit, min_only=True, return_predecessors=True)
+    except TypeError:
+        found, origin = superSource(graph, unique, limit)
+
+    reached = numpy.isfinite(found)
+    dist[reached] = found[reached]
+    nearest[reached] = cafeAt[origin[reached]]
+    return dist, nearest
+
+
+def superSource(graph, sources, limit=numpy.inf):
+    '''
+    * For older versions of scipy: grow one search from an extra node joined to every source, and return the distance
+    * to each node and the source it was reached through
+    '''
+    n = len(graph)
+    matrix = graph.matrix().tocoo()
+
+    # scipy treats edges of no length as missing, so the extra node is joined to the sources by edges a nanometre long
+    rows = numpy.concatenate((matrix.row, numpy.full(len(sources), n)))
+    cols = numpy.concatenate((matrix.col, sources))
+    data = numpy.concatenate((matrix.data, numpy.full(len(sources), 1e-9)))
+    extended = csr_matrix((data, (rows, cols)), shape=(n + 1, n + 1))
+    found, pred = dijkstra(extended, directed=True, indices=n, limit=limit, return_predecessors=True)
+
+    # follow each node's predecessors back until they reach a source (doubling the jump each time, for all of the nodes at once)
+    origin = numpy.where(pred[:n] == n, numpy.arange(n), pred[:n])
+    origin[origin < 0] = 0
+    for step in range(64):
+        jumped = origin[origin]
+        if numpy.array_equal(jumped, origin):
+            break
+        origin = jumped
+    return found[:n], origin
+
+
+def saveField(path, dist, nearest, cafes):
+    '''
+    * Save the labels of every node (and the coordinates of the cafes they refer to) as one compressed numpy file
+    '''
+    numpy.savez_compressed(path, dist=dist, nearest=nearest, cafes=numpy.asarray(cafes, dtype=numpy.float64).reshape(-1, 2))
+
+
+def loadField(path):
+    '''
+    * Return the (dist, nearest, cafes) arrays saved by saveField
+    '''
+    field = numpy.load(path)
+    return field['dist'], field['nearest'], field['cafes']
+
+
+def colours(dist):
+    '''
+    * Return an (n, 3) array of the heatmap colour of each distance
+    '''
+    stops = numpy.array([stop for stop, colour in RAMP], dtype=numpy.float64)
+    ramp = numpy.array([colour for stop, colour in RAMP], dtype=numpy.float64)
+    return numpy.column_stack([numpy.interp(dist, stops, ramp[:, channel]) for channel in range(3)]).astype(numpy.uint8)
+
+
+def rasterise(graph, dist, extent, outPath, cellSize=25, gap=None):
+    '''
+    * Draw the distances as a heatmap covering 'extent' (minX, minY, maxX, maxY in British National Grid metres)
+    *
+    * Each cell of 'cellSize' metres takes the distance of the nearest street node, plus the walk from there to
+    * the cell. Cells more than 'gap' metres (by default, four cells) from any node are left transparent, so only
+    * the streets and the blocks between them are coloured. A world file is saved alongside (e.g. 'cafe_field.pgw').
+    '''
+    gap = 4 * cellSize if gap is None else gap
+    minX, minY, maxX, maxY = extent
+    width, height = int(numpy.ceil((maxX - minX) / cellSize)), int(numpy.ceil((maxY - minY) / cellSize))
+
+    # only the nodes in (or near) the extent are needed
+    x, y = transform(wgs84, bng, numpy.asarray(graph.lon), numpy.asarray(graph.lat))
+    x, y = numpy.asarray(x), numpy.asarray(y)
+    near = (x > minX - gap) & (x < maxX + gap) & (y > minY - gap) & (y < maxY + gap) & numpy.isfinite(dist)
+    pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    if near.any():
+        # the centre of every cell, top row first (as in an image)
+        cx = minX + (numpy.arange(width) + 0.5) * cellSize
+        cy = maxY - (numpy.arange(height) + 0.5) * cellSize
+        gx, gy = numpy.meshgrid(cx, cy)
+        offsets, found = cKDTree(numpy.column_stack((x[near], y[near]))).query(numpy.column_stack((gx.ravel(), gy.ravel())), distance_upper_bound=gap)
+        covered = numpy.isfinite(offsets)
+        value = numpy.asarray(dist[near], dtype=numpy.float64)[found[covered]] + offsets[covered]
+
+        flat = pixels.reshape(-1, 4)
+        flat[covered, :3] = colours(value)
+        flat[covered, 3] = OPACITY
+
+    Image.fromarray(pixels, 'RGBA').save(outPath)
+
+    # the world file gives the size of a cell, and the centre of the top-left cell
+    with open(outPath[:-4] + '.pgw', 'w') as f:
+        f.write('%r\n0.0\n0.0\n%r\n%r\n%r\n' % (float(cellSize), -float(cellSize), minX + cellSize / 2.0, maxY - cellSize / 2.0))
+    return outPath
+
+
+def makeField(xmlPath='data/manchester.xml', polygons='data/osm_polygons.shp', points='data/osm_points.shp', changes=(),
+              maxSnapDist=200, outPath='output/cafe_field.npz'):
+    '''
+    * Find every cafe, label the whole walkable street network with the nearest one, save the labels, and return the graph and labels
+    '''
+    graph = loadGraph(xmlPath, None, None, WALKABLE, changes)
+    cafes = findCafes(polygons, points)
+    cafeNodes, snapDists = graph.snapNodes(cafes, None, maxSnapDist)
+    dist, nearest = nearestCafes(graph, cafeNodes)
+    saveField(outPath, dist, nearest, cafes)
+    return graph, dist, nearest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Label every street node with the walking distance to its nearest cafe.')
+    parser.add_argument('--graph', default='data/manchester.xml', help='the OSM xml file of the street network')
+    parser.add_argument('--polygons', default='data/osm_polygons.shp')
+    parser.add_argument('--points', default='data/osm_points.shp')
+    parser.add_argument('--out', default='output/cafe_field.npz')
+    parser.add_argument('--raster', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help='also draw a heatmap of this area (in British National Grid metres) to output/cafe_field.png')
+    parser.add_argument('--cell', type=float, default=25, help='the size of a heatmap cell, in metres')
+    args = parser.parse_args()
+
+    graph, dist, nearest = makeField(args.graph, args.polygons, args.points, outPath=args.out)
+    reached = numpy.isfinite(dist)
+    print('%d of %d street nodes can reach a cafe' % (reached.sum(), len(graph)))
+    if reached.any():
+        print('median walk to the nearest cafe: %.0f m, and the furthest: %.0f m' % (numpy.median(dist[reached]), dist[reached].max()))
+    if args.raster:
+        print(rasterise(graph, dist, args.raster, 'output/cafe_field.png', args.cell))
+
+
+if __name__ == '__main__':
+    main()
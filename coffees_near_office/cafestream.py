@@ -0,0 +1,53 @@
+'''
+* cafestream.py
+*
+* The pieces of the Step 3 cafe extraction, written as generators so that they can be chained together.
+*
+* Each feature flows straight through: read from a shapefile within a bounding box and filtered by its
+* 'amenity' tag (both at once, using an index, by 'amenityindex.readAmenity'), turned into a centroid
+* point (for polygons), and merged with the others, without ever being written to disk and read back in
+* again. Writing the intermediate shapefiles is still possible, for checking the results, by adding
+* 'writeShapefile' anywhere in the chain.
+'''
+
+from itertools import chain
+
+import fiona
+from shapely.geometry import mapping, shape
+
+
+def centroids(feats):
+    '''
+    * Yield each feature with its geometry replaced by its centroid point
+    '''
+    for feat in feats:
+        yield {'id': feat['id'], 'geometry': mapping(shape(feat['geometry']).centroid), 'properties': feat['properties']}
+
+
+def count(feats, tally, key):
+    '''
+    * Yield the features unchanged, adding up how many went past in tally[key]
+    '''
+    tally.setdefault(key, 0)
+    for feat in feats:
+        tally[key] += 1
+        yield feat
+
+
+def writeShapefile(feats, path, crs, geometry='Point'):
+    '''
+    * Yield the features unchanged, writing each one (with no properties) to a shapefile as it goes past
+    *
+    * This is meant for debugging, as nothing later on needs the file.
+    '''
+    with fiona.open(path, 'w', driver='ESRI Shapefile', crs=crs, schema={'geometry': geometry, 'properties': {}}) as dst:
+        for feat in feats:
+            dst.write({'geometry': feat['geometry'], 'properties': {}})
+            yield feat
+
+
+def merge(*streams):
+    '''
+    * Yield the features of each stream in turn
+    '''
+    return chain(*streams)
@@ -0,0 +1,66 @@
+'''
+* favourites.py
+*
+* Jonny's favourite cafes, read from a config file ('favourites.json') rather than written into the script.
+*
+* Each favourite has a 'label' to show on the map, and is picked out of the cafes by its OSM id ('osm_id'), its
+* OSM name ('name') or its coordinates ('coordinates', as [lon, lat]), whichever is given first in that order.
+* The cafes are looked up through dictionaries of their ids and names, and a KD-tree of their coordinates,
+* rather than by checking every cafe's coordinates for an exact match.
+'''
+
+import json
+
+import numpy
+from scipy.spatial import cKDTree
+
+from walkgraph import localMetres
+
+
+def loadFavourites(path):
+    '''
+    * Read the list of favourites from a JSON config file
+    '''
+    with open(path) as f:
+        favourites = json.load(f)
+    for fav in favourites:
+        if not any(key in fav for key in ('osm_id', 'name', 'coordinates')):
+            raise ValueError("favourite %r needs an 'osm_id', a 'name' or 'coordinates'" % fav.get('label'))
+        fav.setdefault('label', fav.get('name') or str(fav.get('osm_id') or fav['coordinates']))
+    return favourites
+
+
+class CafeLookup(object):
+    '''
+    * An index of a list of cafe features, by OSM id, by name (ignoring case) and by coordinates
+    '''
+
+    def __init__(self, cafes):
+        self.byId = {}
+        self.byName = {}
+        for k, cafe in enumerate(cafes):
+            props = cafe['properties']
+            if props.get('osm_id'):
+                self.byId.setdefault(str(props['osm_id']), k)
+            if props.get('name'):
+                self.byName.setdefault(props['name'].lower(), k)
+
+        coords = numpy.array([cafe['geometry']['coordinates'][:2] for cafe in cafes], dtype=numpy.float64).reshape(-1, 2)
+        self.midLat = float(coords[:, 1].mean()) if len(coords) else 0.0
+        self.kdtree = cKDTree(localMetres(coords[:, 0], coords[:, 1], self.midLat)) if len(coords) else None
+
+    def find(self, favourite, tolerance=25):
+        '''
+        * Return the position of the favourite in the list of cafes, or None if it is not there
+        *
+        * Favourites given by coordinates match the nearest cafe within 'tolerance' metres.
+        '''
+        if 'osm_id' in favourite:
+            return self.byId.get(str(favourite['osm_id']))
+        if 'name' in favourite:
+            return self.byName.get(favourite['name'].lower())
+        if self.kdtree is None:
+            return None
+        lon, lat = favourite['coordinates']
+        dist, k = self.kdtree.query(localMetres([lon], [lat], self.midLat)[0], distance_upper_bound=tolerance)
+        return int(k) if numpy.isfinite(dist) else None
@@ -0,0 +1,112 @@
+'''
+* isochrones.py
+*
+* Turn a single walk search (see 'walksearch.py') into walk-time bands: the areas within 5, 10, 15... minutes' walk.
+*
+* For each band, every street the search reached within the band's walking distance is drawn as a line (a street
+* that was only reached part of the way along is cut off at the point where the distance runs out), and the lines
+* are buffered by how far a cafe can be from a street, in the British National Grid. Each band is then a polygon,
+* so any number of cafes can be sorted into bands at once, by testing them against prepared copies of the polygons
+* (which are indexed internally, so each test is quick). The bands are also saved as a shapefile, for the map.
+'''
+
+import fiona
+import numpy
+from fiona.crs import from_epsg
+from pyproj import transform
+from shapely.geometry import LineString, Point, Polygon, mapping
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from renderdata import bng, wgs84
+
+
+def reachedSegments(tree, limit):
+    '''
+    * Return the parts of the streets reached within 'limit' metres, as an array of ((x, y), (x, y)) lines in the British National Grid
+    '''
+    graph = tree.graph
+    rows = numpy.repeat(numpy.arange(len(graph)), numpy.diff(graph.indptr))
+    cols = numpy.asarray(graph.indices)
+    lengths = numpy.asarray(graph.edgeDist)
+
+    # each street is stored both ways round, so each copy gives the part of the street that can be reached from its own end...
+    fromDist, toDist = tree.dist[rows], tree.dist[cols]
+    reached = fromDist < limit
+
+    # ...apart from streets that can be walked all the way along from either end, which only need drawing once
+    whole = (fromDist + lengths <= limit) & (toDist + lengths <= limit)
+    reached &= ~whole | (rows < cols)
+    rows, cols, fromDist, lengths = rows[reached], cols[reached], fromDist[reached], lengths[reached]
+
+    # find how far along each street the distance runs out (the whole way, for streets of no length)
+    fraction = numpy.ones(len(rows))
+    measured = lengths > 0
+    fraction[measured] = numpy.minimum((limit - fromDist[measured]) / lengths[measured], 1.0)
+
+    # work in the British National Grid, so the lines can be cut and buffered in metres
+    nodes = numpy.unique(numpy.concatenate((rows, cols)))
+    x, y = numpy.zeros(len(graph)), numpy.zeros(len(graph))
+    if len(nodes):
+        x[nodes], y[nodes] = transform(wgs84, bng, numpy.asarray(graph.lon)[nodes], numpy.asarray(graph.lat)[nodes])
+    starts = numpy.column_stack((x[rows], y[rows]))
+    ends = starts + fraction[:, None] * (numpy.column_stack((x[cols], y[cols])) - starts)
+    return numpy.stack((starts, ends), axis=1)
+
+
+def bandPolygons(tree, limits, reach):
+    '''
+    * Return a polygon (in the British National Grid) for each walking distance in 'limits', covering everywhere within
+    * 'reach' metres of a street that can be walked to within that distance
+    '''
+    polygons = []
+    for limit in limits:
+
+        # buffering each piece of street on its own and then joining them all up in one go is far quicker than buffering the
+        # whole network as one shape (the buffers of neighbouring streets overlap a lot). A quarter circle is drawn with 4
+        # lines, which is within 2% of the reach
+        buffers = [LineString(segment).buffer(reach, 4) for segment in reachedSegments(tree, limit).tolist()]
+        polygons.append(unary_union(buffers) if buffers else Polygon())
+    return polygons
+
+
+def classify(coordinates, polygons):
+    '''
+    * Return the position in 'polygons' of the smallest band each (lon, lat) point falls in (or None if it isn't in any)
+    *
+    * The bands are nested (the 10 minute band covers the 5 minute band), so each point is first tested against the
+    * biggest band, and only the points inside it are tested against the smaller ones.
+    '''
+    if not len(coordinates):
+        return []
+    lons, lats = numpy.asarray(coordinates, dtype=numpy.float64).reshape(-1, 2).T
+    points = [Point(xy) for xy in zip(*transform(wgs84, bng, lons, lats))]
+
+    bands = [None] * len(points)
+    inside = list(range(len(points)))
+    for band in range(len(polygons) - 1, -1, -1):
+        if polygons[band].is_empty:
+            break
+        prepared = prep(polygons[band])
+        inside = [k for k in inside if prepared.contains(points[k])]
+        for k in inside:
+            bands[k] = band
+    return bands
+
+
+def writeBands(path, minutes, polygons):
+    '''
+    * Save the bands to a shapefile in the British National Grid, as rings (so each band only covers what the band
+    * inside it doesn't), with the walk time in minutes that each one goes up to
+    '''
+    schema = {'geometry': 'MultiPolygon', 'properties': {'minutes': 'int'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', crs=from_epsg(27700), schema=schema) as dst:
+        inner = None
+        for walk, polygon in zip(minutes, polygons):
+            ring = polygon if inner is None else polygon.difference(inner)
+            inner = polygon
+            if ring.is_empty:
+                continue
+            geometry = mapping(ring)
+            if geometry['type'] == 'Polygon':
+                geometry = {'type': 'MultiPolygon', 'coordinates': [geometry['coordinates']]}
+            dst.write({'geometry': geometry, 'properties': {'minutes': int(walk)}})
@@ -0,0 +1,101 @@
+'''
+* mapimage.py
+*
+* Render the map straight into memory, and draw the north arrow, key, text and scale bar onto it there.
+*
+* Step 9 used to render the map to a PNG file, and Step 10 read it straight back in (decoding all 1600x1600
+* pixels again) just to draw on it, before saving it as a PNG once more. Instead, the map is rendered into a
+* mapnik.Image, and PIL is handed that image's own pixels to draw on, so nothing is copied, encoded or decoded
+* until the final save. The north arrow, the key and the fonts never change, so they are loaded (and resized)
+* once, and kept for every map drawn after that (e.g. when many maps are rendered in one go).
+'''
+
+import mapnik
+from PIL import Image, ImageDraw, ImageFont
+from scalebar import addScaleBar
+
+TITLE = 'A map of all the cafes within a 30-minute walking distance of Jonnys office'
+ATTRIBUTION = 'Data Copyright OpenStreetMap Contributors'
+
+# the decorations, loaded the first time a map is decorated
+_cache = {}
+
+
+def toPil(image):
+    '''
+    * Return a PIL image that shares the pixels of a mapnik.Image
+    *
+    * If this build of mapnik cannot share its pixel buffer, PIL gets a copy of the raw pixels instead (which
+    * is still far cheaper than a PNG file), and draws on its own copy.
+    '''
+    # mapnik keeps the colours of each pixel 'premultiplied' by its transparency, but PIL expects them separately
+    if hasattr(image, 'demultiply'):
+        image.demultiply()
+
+    try:
+        pixels = memoryview(image)
+    except TypeError:
+        pixels = image.tostring()
+    pilImg = Image.frombuffer('RGBA', (image.width(), image.height()), pixels, 'raw', 'RGBA', 0, 1)
+
+    # PIL marks an image made from a buffer as read-only, and would copy it all before the first change; but this
+    # buffer is ours to draw on (the memoryview keeps the mapnik.Image alive for as long as PIL needs it)
+    if isinstance(pixels, memoryview) and not pixels.readonly:
+        pilImg.readonly = 0
+    return pilImg
+
+
+def renderImage(m):
+    '''
+    * Render the mapnik map 'm' into memory, and return it as a PIL image
+    '''
+    image = mapnik.Image(m.width, m.height)
+    mapnik.render(m, image)
+    return toPil(image)
+
+
+class Decorations(object):
+    '''
+    * The parts drawn on top of every map that never change
+    '''
+
+    def __init__(self):
+        # the north arrow and the key, resized (with ANTIALIAS to prevent pixelation) to fit the map
+        self.northArrow = Image.open('data/icons/north.png').resize((75,75), Image.ANTIALIAS)
+        self.key = Image.open('data/icons/key.png').resize((343,480), Image.ANTIALIAS)
+
+        # the fonts for the copyright attribution text and the (bold) title
+        self.font = ImageFont.truetype('data/helvetica.ttf', 14)
+        self.fontBold = ImageFont.truetype('data/helvetica_bold.ttf', 35)
+
+
+def decorations():
+    if 'decorations' not in _cache:
+        _cache['decorations'] = Decorations()
+    return _cache['decorations']
+
+
+def decorate(mapImg, m, title=TITLE, attribution=ATTRIBUTION):
+    '''
+    * Draw the north arrow, the key, the copyright attribution text, the title and the scale bar onto 'mapImg'
+    '''
+    deco = decorations()
+
+    # paste the arrow 20 pixels away from the top-left of the map, using itself as a 'mask' to keep its background transparent
+    mapImg.paste(deco.northArrow, (20, 20), deco.northArrow)
+
+    # paste the key on the bottom-left of the map
+    mapImg.paste(deco.key, (9, m.height-530))
+
+    # measure the attribution text, and write it on the bottom-right of the map
+    draw = ImageDraw.Draw(mapImg)
+    aw, ah = draw.textsize(attribution)
+    draw.text((m.width-43-aw, m.height-10-ah), attribution, fill=(0,0,0), font=deco.font)
+
+    # measure the title, and write it on the top-centre of the map
+    tw, th = draw.textsize(title)
+    draw.text((m.width/2-tw-170, 30-th), title, fill=(0,0,0), font=deco.fontBold)
+
+    # add a scale bar, using Jonny's 'scalebar' code
+    addScaleBar(m, mapImg, True)
+    return mapImg
@@ -0,0 +1,184 @@
+'''
+* mapstyle.py
+*
+* Compile the map's styles and layers (described in 'mapstyle.json') into a mapnik XML stylesheet, once.
+*
+* Steps 6-8 used to build every mapnik.Rule in Python on every run, and several rules were identical apart
+* from their filter (the five greenspace rules, or buildings, parking and schools). When compiling, runs of
+* neighbouring rules that draw exactly the same thing are merged into a single rule with an 'or' filter, so
+* mapnik checks each feature against fewer rules. Rules can also have a 'minScale' and 'maxScale' (scale
+* denominators), so that buildings and other small features are skipped altogether when zoomed out.
+* Layers can have scales too, which is how the background layers switch between the generalised copies
+* made by 'renderdata.py'. A layer is read from a shapefile, unless it names another mapnik 'datasource'
+* (e.g. "gdal", for a raster), and an 'optional' layer is only added to the map if its file is there.
+*
+* The compiled stylesheet is saved (by default as 'output/cafes_style.xml'), along with a hash of the
+* description it came from, and is only compiled again when the description changes.
+*
+* To measure how much faster the compiled style renders than the plain one (one rule per filter, no scales):
+*
+*   python mapstyle.py --benchmark
+'''
+
+import argparse, hashlib, json, os, time
+import xml.etree.ElementTree as ET
+
+import mapnik
+
+# bump this whenever the compiler changes, so stylesheets compiled by an older version get compiled again
+COMPILER_VERSION = 3
+
+# the coordinate reference system of the OSM shapefiles (mapnik's default for a layer)
+LAYER_SRS = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
+
+
+def mergeRules(rules):
+    '''
+    * Merge each run of neighbouring rules that have the same symbolizers and scales into one rule
+    *
+    * Only neighbouring rules are merged, so everything is still drawn in the same order.
+    '''
+    merged = []
+    for rule in rules:
+        previous = merged[-1] if merged else None
+        if (previous is not None and 'filter' in rule and 'filters' in previous
+                and rule['symbolizers'] == previous['symbolizers']
+                and rule.get('minScale') == previous.get('minScale') and rule.get('maxScale') == previous.get('maxScale')):
+            previous['filters'].append(rule['filter'])
+        else:
+            merged.append(dict(rule, filters=[rule['filter']]) if 'filter' in rule else dict(rule))
+    for rule in merged:
+        filters = rule.pop('filters', None)
+        if filters:
+            rule['filter'] = filters[0] if len(filters) == 1 else ' or '.join('(%s)' % f for f in filters)
+    return merged
+
+
+def symbolizerElement(symbolizer):
+    '''
+    * Turn a symbolizer description, e.g. {"type": "line", "stroke": "red", "stroke-width": 5}, into XML
+    '''
+    attrs = {}
+    for name, value in symbolizer.items():
+        if name != 'type':
+            attrs[name] = ('true' if value else 'false') if isinstance(value, bool) else str(value)
+    return ET.Element(symbolizer['type'].capitalize() + 'Symbolizer', attrs)
+
+
+def compileSpec(spec, merge=True, scales=True):
+    '''
+    * Return the mapnik XML (as a string) for a style description
+    '''
+    root = ET.Element('Map', {'background-color': spec['background'], 'srs': spec['srs']})
+
+    for name in sorted(spec['styles']):
+        rules = spec['styles'][name]
+        style = ET.SubElement(root, 'Style', {'name': name})
+        for rule in (mergeRules(rules) if merge else rules):
+            r = ET.SubElement(style, 'Rule')
+            if scales and 'minScale' in rule:
+                ET.SubElement(r, 'MinScaleDenominator').text = str(rule['minScale'])
+            if scales and 'maxScale' in rule:
+                ET.SubElement(r, 'MaxScaleDenominator').text = str(rule['maxScale'])
+            if 'filter' in rule:
+                ET.SubElement(r, 'Filter').text = rule['filter']
+            for symbolizer in rule['symbolizers']:
+                r.append(symbolizerElement(symbolizer))
+
+    for layer in spec['layers']:
+        if layer.get('optional') and not os.path.exists(layer['file']):
+            continue
+
+        # layers that are already in the map's projection ('projected') are drawn without reprojecting them
+        attrs = {'name': layer['name'], 'srs': spec['srs'] if layer.get('projected') else layer.get('srs', LAYER_SRS)}
+
+        # layers with scales are only drawn between them (these always apply, as they pick between generalised copies)
+        if 'minScale' in layer:
+            attrs['minimum-scale-denominator'] = str(layer['minScale'])
+        if 'maxScale' in layer:
+            attrs['maximum-scale-denominator'] = str(layer['maxScale'])
+        l = ET.SubElement(root, 'Layer', attrs)
+        for name in layer['styles']:
+            ET.SubElement(l, 'StyleName').text = name
+        datasource = ET.SubElement(l, 'Datasource')
+        ET.SubElement(datasource, 'Parameter', {'name': 'type'}).text = layer.get('datasource', 'shape')
+        ET.SubElement(datasource, 'Parameter', {'name': 'file'}).text = layer['file']
+
+    return ET.tostring(root).decode('utf-8')
+
+
+def compileStyle(specPath='mapstyle.json', outPath='output/cafes_style.xml', merge=True, scales=True):
+    '''
+    * Compile a style description to a mapnik XML file (unless it already has been), and return the file's path
+    '''
+    with open(specPath, 'rb') as f:
+        source = f.read()
+    spec = json.loads(source.decode('utf-8'))
+
+    # the stylesheet depends on which of the optional layers' files are there, as well as on the description
+    present = ''.join('1' if os.path.exists(layer['file']) else '0' for layer in spec['layers'] if layer.get('optional'))
+    stamp = '%s %d %s %s %s' % (hashlib.sha1(source).hexdigest(), COMPILER_VERSION, merge, scales, present)
+    header = '<!-- compiled from %s: %s -->\n' % (os.path.basename(specPath), stamp)
+
+    # if the stylesheet was compiled from exactly this description, there is nothing to do
+    if os.path.exists(outPath):
+        with open(outPath) as f:
+            if f.readline() == header:
+                return outPath
+
+    xml = compileSpec(spec, merge, scales)
+    with open(outPath, 'w') as f:
+        f.write(header)
+        f.write(xml)
+    return outPath
+
+
+def loadStyle(m, specPath='mapstyle.json', outPath='output/cafes_style.xml', merge=True, scales=True):
+    '''
+    * Load the (compiled) styles and layers onto the mapnik map 'm'
+    '''
+    # the shapefiles in the stylesheet are relative to this folder (where the main script runs), not to the stylesheet's own folder
+    mapnik.load_map(m, compileStyle(specPath, outPath, merge, scales), False, os.path.abspath('.'))
+
+
+def benchmark(box, frames=5, specPath='mapstyle.json'):
+    '''
+    * Render the map with the plain and the compiled style at a few zoom levels, and return the mean time per frame
+    '''
+    results = {}
+    for label, merge, scales in (('plain', False, False), ('compiled', True, True)):
+        m = mapnik.Map(1600, 1600)
+        loadStyle(m, specPath, 'output/cafes_style_%s.xml' % label, merge, scales)
+        times = []
+        for zoomOut in (1, 4, 16):
+            cx, cy = (box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0
+            w, h = (box[2] - box[0]) * zoomOut / 2.0, (box[3] - box[1]) * zoomOut / 2.0
+            m.zoom_to_box(mapnik.Box2d(cx - w, cy - h, cx + w, cy + h))
+            for frame in range(frames):
+                image = mapnik.Image(m.width, m.height)
+                started = time.time()
+                mapnik.render(m, image)
+                times.append(time.time() - started)
+        results[label] = sum(times) / len(times)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile 'mapstyle.json' into a mapnik stylesheet.")
+    parser.add_argument('--spec', default='mapstyle.json')
+    parser.add_argument('--out', default='output/cafes_style.xml')
+    parser.add_argument('--benchmark', action='store_true', help='compare the render time of the plain and the compiled style')
+    parser.add_argument('--box', type=float, nargs=4, default=[381000, 395000, 387000, 401000], metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help='the area to render for the benchmark, in British National Grid metres (default: central Manchester)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        results = benchmark(args.box, specPath=args.spec)
+        print('plain style:    %.3f seconds per frame' % results['plain'])
+        print('compiled style: %.3f seconds per frame (%.0f%% faster)' % (results['compiled'], 100 * (1 - results['compiled'] / results['plain'])))
+    else:
+        print(compileStyle(args.spec, args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+'''
+* osmchange.py
+*
+* Apply an OpenStreetMap change file ('.osc', or '.osc.gz') to a streamed walking graph snapshot, without reading the xml again.
+*
+* A change file lists the nodes and ways that were created, modified or deleted since the last one (a modified way
+* comes with its whole new list of nodes and tags, but not the coordinates of any nodes that did not change). So the
+* snapshot keeps every node in and around its area, and every walkable way through those nodes (see 'osmstream.py'),
+* and these are brought up to date first. Then only the edges at the nodes the change mentions (and at every node of
+* the old and new versions of the ways it mentions) can have changed: the ways through those nodes are walked again,
+* and only the rows of the graph at those nodes and their neighbours are patched (see 'walkgraph.patchGraph'). The
+* rest of the graph keeps its edges, their lengths and its component labels, and only the arrays that actually
+* changed are written back to the snapshot, so the time this takes is down to the size of the change file, apart
+* from a few quick passes over the arrays (in numpy) to splice the changes in.
+*
+* The one thing this cannot do is move a node into the area from further away than the margin kept around it (see
+* 'SOURCE_MARGIN'), as the snapshot doesn't know which ways such a node is on. If that happens, the snapshot is built
+* again, by streaming the xml with all of the change files read in place of what they changed (see 'walkgraph.py').
+*
+* To check that applying the change files one by one gives the same graph as building it again from scratch:
+*
+*   python osmchange.py verify --bbox -2.28 53.46 -2.21 53.50
+'''
+
+import argparse, gzip, sys
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import numpy
+from osmstream import WALKABLE, inBbox, inside, streamOsm, walkable, wayEdges, widenBbox
+from walkgraph import changeFiles, compileSource, loadGraph, measureEdges, patchGraph, snapshotArea
+
+
+class RebuildNeeded(Exception):
+    '''
+    * Raised when a change file moves a node into the area that the snapshot doesn't know the ways of
+    '''
+    pass
+
+
+def readChange(path):
+    '''
+    * Read a change file, and return the final state of each node and way it mentions
+    *
+    * Returns two dicts: node id -> (lon, lat), and way id -> (list of node ids, dict of tags), with None for
+    * anything that was deleted, and the set of ids of the nodes it created. If a change file mentions the same
+    * node or way twice, the later one wins.
+    '''
+    nodes, ways, created = {}, {}, set()
+    action = None
+
+    f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    with f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        event, root = next(context)
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ('create', 'modify', 'delete'):
+                    action = elem.tag
+                continue
+
+            if elem.tag == 'node':
+                if action == 'delete':
+                    nodes[int(elem.get('id'))] = None
+                else:
+                    nodes[int(elem.get('id'))] = (float(elem.get('lon')), float(elem.get('lat')))
+                    if action == 'create':
+                        created.add(int(elem.get('id')))
+            elif elem.tag == 'way':
+                if action == 'delete':
+                    ways[int(elem.get('id'))] = None
+                else:
+                    tags = dict((tag.get('k'), tag.get('v')) for tag in elem.findall('tag'))
+                    ways[int(elem.get('id'))] = ([int(nd.get('ref')) for nd in elem.findall('nd')], tags)
+            elif elem.tag != 'relation':
+                continue
+
+            # throw away everything read so far (the element itself, and its place in the tree)
+            elem.clear()
+            root.clear()
+
+    return nodes, ways, created
+
+
+def readChanges(paths):
+    '''
+    * Read several change files in order, and return the final state of each node and way any of them mentions (see 'readChange')
+    '''
+    nodes, ways = {}, {}
+    for path in paths:
+        changedNodes, changedWays, created = readChange(path)
+        nodes.update(changedNodes)
+        ways.update(changedWays)
+    return nodes, ways
+
+
+def applyChange(graph, arrays, path, bbox=None, highways=WALKABLE):
+    '''
+    * Apply the change file 'path' to a WalkGraph and the arrays it was compiled from (see 'streamOsm')
+    *
+    * Returns the new graph and arrays, and whether the graph changed at all. Anything that did not change (the
+    * graph itself, or any one of its arrays or of 'arrays') is returned as it was, not as a copy. Raises
+    * RebuildNeeded if the change moves a node into 'bbox' that the arrays don't know the ways of.
+    '''
+    ids, lon, lat, wayIds, wayPtr, wayRefs = arrays
+    nodes, ways, created = readChange(path)
+    sourceBox = widenBbox(bbox)
+
+    ## first, the nodes: move or delete the ones the snapshot knows of, and add the new ones around the area. A node it knows of
+    ## stays known wherever it goes, as its ways are all known too; one that it doesn't know of can only be new (in which case any
+    ## ways it is on are in the change too), or have come from further away than the margin, and if it lands in the area, the
+    ## ways it is on have to be found in the xml
+    changedIds = numpy.array(sorted(nodes), dtype=numpy.int64)
+    known = inside(ids, changedIds)
+    positions = numpy.searchsorted(ids, changedIds)
+    moved, dropped, added = [], [], []
+    for nodeId, isKnown, at in zip(changedIds.tolist(), known.tolist(), positions.tolist()):
+        point = nodes[nodeId]
+        if isKnown:
+            if point is None:
+                dropped.append(at)
+            elif (lon[at], lat[at]) != point:
+                moved.append((at, point))
+        elif point is not None:
+            if nodeId in created:
+                if inBbox(sourceBox, point[0], point[1]):
+                    added.append((nodeId, point))
+            elif inBbox(bbox, point[0], point[1]):
+                raise RebuildNeeded('node %d was moved into the area from too far away' % nodeId)
+
+    if moved:
+        lon, lat = numpy.array(lon), numpy.array(lat)
+        for at, point in moved:
+            lon[at], lat[at] = point
+    if dropped:
+        ids, lon, lat = numpy.delete(ids, dropped), numpy.delete(lon, dropped), numpy.delete(lat, dropped)
+    if added:
+        newIds = numpy.array([nodeId for nodeId, point in added], dtype=numpy.int64)
+        at = numpy.searchsorted(ids, newIds)
+        ids = numpy.insert(ids, at, newIds)
+        lon = numpy.insert(lon, at, [point[0] for nodeId, point in added])
+        lat = numpy.insert(lat, at, [point[1] for nodeId, point in added])
+
+    ## then the ways: drop every way the change mentions (noting the nodes they went through), then add back those that
+    ## are (still) walkable and go through any of the nodes around the area
+    oldRefs = newRefs = numpy.zeros(0, dtype=numpy.int64)
+    if ways:
+        lengths = numpy.diff(wayPtr)
+        keep = ~numpy.isin(wayIds, numpy.array(sorted(ways), dtype=numpy.int64))
+        oldRefs = wayRefs[numpy.repeat(~keep, lengths)]
+
+        newWays = [(wayId, way[0]) for wayId, way in sorted(ways.items()) if way is not None and walkable(way[1], highways)]
+        newWays = [(wayId, refs) for wayId, refs in newWays if sourceBox is None or inside(ids, refs).any()]
+        if len(oldRefs) or newWays:
+            newRefs = numpy.array([ref for wayId, refs in newWays for ref in refs], dtype=numpy.int64)
+            wayIds = numpy.concatenate((wayIds[keep], numpy.array([wayId for wayId, refs in newWays], dtype=numpy.int64)))
+            lengths = numpy.concatenate((lengths[keep], numpy.array([len(refs) for wayId, refs in newWays], dtype=numpy.int64)))
+            wayRefs = numpy.concatenate((wayRefs[numpy.repeat(keep, numpy.diff(wayPtr))], newRefs))
+            wayPtr = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths, out=wayPtr[1:])
+    arrays = (ids, lon, lat, wayIds, wayPtr, wayRefs)
+
+    ## only the edges at these 'dirty' nodes can have come, gone or changed length
+    dirty = numpy.unique(numpy.concatenate((changedIds, oldRefs, newRefs)))
+    if not len(dirty):
+        return graph, arrays, False
+
+    # find the edges at the dirty nodes again, along the ways that pass through them now, keeping those with both ends in the area
+    seen = numpy.concatenate(([0], numpy.cumsum(inside(dirty, wayRefs))))
+    passes = seen[wayPtr[1:]] > seen[wayPtr[:-1]]
+    passLengths = numpy.diff(wayPtr)[passes]
+    passPtr = numpy.zeros(len(passLengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(passLengths, out=passPtr[1:])
+    u, v = wayEdges(ids, passPtr, wayRefs[numpy.repeat(passes, numpy.diff(wayPtr))])
+    new = (inside(dirty, ids[u]) | inside(dirty, ids[v])) & inBbox(bbox, lon[u], lat[u]) & inBbox(bbox, lon[v], lat[v])
+    u, v = u[new], v[new]
+
+    ## and patch them into the graph
+    newGraph = patchGraph(graph, dirty, ids[u], ids[v], measureEdges(lon, lat, u, v), (ids, lon, lat))
+    return newGraph, arrays, newGraph is not graph
+
+
+def verifyChanges(xmlPath, bbox, highways=WALKABLE, changes=()):
+    '''
+    * Check that the snapshot of an OSM xml file, with the change files applied to it one by one, is the same graph as
+    * one built from scratch from the xml with all of the change files read in place of what they changed
+    *
+    * Returns a list of the differences found (so an empty list means they are the same).
+    '''
+    # (the same, rounded, box and tags as the snapshot uses)
+    area = snapshotArea(bbox, highways, changes)
+    applied = loadGraph(xmlPath, None, bbox, highways, changes)
+    rebuilt = compileSource(streamOsm(xmlPath, widenBbox(area['bbox']), frozenset(area['highways']), readChanges(changes)), area['bbox'])
+
+    problems = []
+    if not numpy.array_equal(applied.nodeIds, rebuilt.nodeIds):
+        problems.append('the nodes differ: %d nodes, rather than %d' % (len(applied), len(rebuilt)))
+        return problems
+    if not (numpy.array_equal(applied.lon, rebuilt.lon) and numpy.array_equal(applied.lat, rebuilt.lat)):
+        problems.append('the nodes are in different places')
+    if not (numpy.array_equal(applied.indptr, rebuilt.indptr) and numpy.array_equal(applied.indices, rebuilt.indices)):
+        problems.append('the edges differ: %d edges, rather than %d' % (len(applied.indices), len(rebuilt.indices)))
+    elif not numpy.allclose(applied.edgeDist, rebuilt.edgeDist, rtol=0, atol=1e-6):
+        problems.append('the edges are different lengths')
+
+    # the component labels themselves are arbitrary, but they must split the nodes up in the same way
+    pairs = set(zip(numpy.asarray(applied.component).tolist(), numpy.asarray(rebuilt.component).tolist()))
+    if not len(pairs) == len(set(a for a, b in pairs)) == len(set(b for a, b in pairs)):
+        problems.append('the nodes are split into components differently')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that applying OSM change files to a walking graph snapshot gives the same graph as building it again.')
+    commands = parser.add_subparsers(dest='command')
+    verify = commands.add_parser('verify', help='apply the change files to the snapshot, and compare it with one built from scratch')
+    verify.add_argument('--xml', default='data/manchester.xml', help='the OSM xml file (default: data/manchester.xml)')
+    verify.add_argument('--bbox', type=float, nargs=4, required=True, metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'), help='the area of the snapshot')
+    verify.add_argument('--changes', nargs='*', help='the change files, in order (default: the ones in data/changes)')
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        changes = args.changes if args.changes is not None else changeFiles()
+        problems = verifyChanges(args.xml, tuple(args.bbox), WALKABLE, changes)
+        for problem in problems:
+            print(problem)
+        print('Applied %d change files: %s' % (len(changes), 'the same graph as building it again' if not problems else 'NOT the same graph'))
+        if problems:
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''
+* osmstream.py
+*
+* Read only the walkable streets in one area out of an OSM xml file, without ever holding the whole file in memory.
+*
+* osm2nx builds a networkx graph of every way in the file, however far it is from the office and whether or not
+* it can be walked along, which gets out of hand for a regional or national extract. Instead, the file is streamed
+* through one element at a time (each element is thrown away as soon as it has been read). The nodes inside the
+* area are kept as plain arrays of numbers (24 bytes each), and of the ways, only those with a walkable 'highway'
+* tag that pass through the area are kept, as lists of node ids. At the end, only the nodes that those ways pass
+* through are put in the graph, so the finished graph is about the size of the walkable network in the area, and
+* no bigger. (All the nodes in and around the area, and the walkable ways through them, are kept alongside the
+* graph's snapshot, so that OSM change files can be applied to it later on; see 'osmchange.py'.)
+'''
+
+from array import array
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import numpy
+from pyproj import Geod
+
+# the 'highway' tags that can be walked along (motorways, and roads that are only planned or being built, are left out)
+WALKABLE = frozenset([
+    'footway', 'path', 'pedestrian', 'steps', 'living_street', 'residential', 'service', 'unclassified', 'road', 'track',
+    'cycleway', 'bridleway', 'tertiary', 'tertiary_link', 'secondary', 'secondary_link', 'primary', 'primary_link',
+    'trunk', 'trunk_link',
+])
+
+# the 'foot' tags that allow walking along a way, even if its 'access' tag says otherwise
+FOOT_ALLOWED = frozenset(['yes', 'designated', 'permissive'])
+
+# how far (in metres) around the area the nodes, and the walkable ways through them, are kept for applying change files to,
+# so that a node that is moved a little way into the area brings the ways it is on with it (see 'osmchange.py')
+SOURCE_MARGIN = 500
+
+# a typecode for 64-bit node ids ('q' only exists in Python 3; 'l' is 64 bits on 64-bit Linux and macOS)
+try:
+    array('q')
+    ID_TYPE = 'q'
+except ValueError:
+    ID_TYPE = 'l'
+
+
+def radiusBbox(lon, lat, radius):
+    '''
+    * Return the (minLon, minLat, maxLon, maxLat) box that covers a circle of 'radius' metres around (lon, lat)
+    *
+    * This is worked out like the Step 3 bounding box: with the Forward Vincenty method, out to the corners.
+    '''
+    g = Geod(ellps='airy')
+    blX, blY, bAz = g.fwd(lon, lat, 225, radius * (2**0.5))
+    trX, trY, bAz = g.fwd(lon, lat, 45, radius * (2**0.5))
+    return (blX, blY, trX, trY)
+
+
+def widenBbox(bbox, margin=SOURCE_MARGIN):
+    '''
+    * Return the (minLon, minLat, maxLon, maxLat) box 'margin' metres further out than 'bbox' on every side (or None for no box)
+    '''
+    if bbox is None:
+        return None
+    g = Geod(ellps='airy')
+    blX, blY, bAz = g.fwd(bbox[0], bbox[1], 225, margin * (2**0.5))
+    trX, trY, bAz = g.fwd(bbox[2], bbox[3], 45, margin * (2**0.5))
+    return (blX, blY, trX, trY)
+
+
+def inBbox(bbox, lon, lat):
+    '''
+    * Return whether (lon, lat) is inside 'bbox' (each may be a number or an array; no box covers everywhere)
+    '''
+    if bbox is None:
+        return numpy.ones(numpy.shape(lon), dtype=bool) if numpy.ndim(lon) else True
+    return (bbox[0] <= lon) & (lon <= bbox[2]) & (bbox[1] <= lat) & (lat <= bbox[3])
+
+
+def walkable(tags, highways):
+    if tags.get('highway') not in highways:
+        return False
+    if tags.get('foot') == 'no':
+        return False
+    return tags.get('access') not in ('no', 'private') or tags.get('foot') in FOOT_ALLOWED
+
+
+def streamOsm(path, bbox=None, highways=WALKABLE, changed=None):
+    '''
+    * Stream through an OSM xml file, and return the nodes inside 'bbox' (or everywhere) and the walkable ways through them
+    *
+    * Returns (ids, lon, lat, wayIds, wayPtr, wayRefs): the OSM ids (sorted) and coordinates of every node in the box,
+    * and the walkable ways that pass through the box, with the ids of the nodes along way k (including any outside
+    * the box) in wayRefs[wayPtr[k]:wayPtr[k+1]]. Ways that never enter the box are left out altogether.
+    *
+    * 'changed' can give the nodes and ways that change files have made or changed since the xml was written (as two
+    * dicts, like 'osmchange.readChanges' returns). These are read instead of the ones in the xml, as if it had been updated.
+    '''
+    ids, lons, lats = array(ID_TYPE), array('d'), array('d')
+    wayIds, wayLengths, wayRefs = array(ID_TYPE), array(ID_TYPE), array(ID_TYPE)
+    nodeIds = None
+    changedNodes, changedWays = (dict(changed[0]), dict(changed[1])) if changed is not None else ({}, {})
+
+    def addNode(nodeId, point):
+        if point is not None and (bbox is None or (bbox[0] <= point[0] <= bbox[2] and bbox[1] <= point[1] <= bbox[3])):
+            ids.append(nodeId)
+            lons.append(point[0])
+            lats.append(point[1])
+
+    def addWay(wayId, way):
+        if way is not None and walkable(way[1], highways) and (bbox is None or inside(nodeIds, way[0]).any()):
+            wayIds.append(wayId)
+            wayLengths.append(len(way[0]))
+            wayRefs.extend(way[0])
+
+    def finishNodes():
+        # add the nodes that are only in the change files, and put all of the nodes in order of id
+        for nodeId, point in sorted(changedNodes.items()):
+            addNode(nodeId, point)
+        changedNodes.clear()
+        return sortedNodes(ids, lons, lats)
+
+    context = ET.iterparse(path, events=('start', 'end'))
+    event, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+
+        if elem.tag == 'node':
+            if changedNodes and int(elem.get('id')) in changedNodes:
+                addNode(int(elem.get('id')), changedNodes.pop(int(elem.get('id'))))
+            else:
+                lon, lat = float(elem.get('lon')), float(elem.get('lat'))
+                if bbox is None or (bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                    addNode(int(elem.get('id')), (lon, lat))
+        elif elem.tag == 'way':
+
+            # OSM files list all of their nodes before their ways, so the nodes in the box are all known by now
+            if nodeIds is None:
+                nodeIds, nodeLon, nodeLat = finishNodes()
+            wayId = int(elem.get('id'))
+            if wayId in changedWays:
+                addWay(wayId, changedWays.pop(wayId))
+            else:
+                tags = dict((tag.get('k'), tag.get('v')) for tag in elem.findall('tag'))
+                if walkable(tags, highways):
+                    addWay(wayId, ([int(nd.get('ref')) for nd in elem.findall('nd')], tags))
+        elif elem.tag != 'relation':
+            continue
+
+        # throw away everything read so far (the element itself, and its place in the tree)
+        elem.clear()
+        root.clear()
+
+    if nodeIds is None:
+        nodeIds, nodeLon, nodeLat = finishNodes()
+
+    # and last of all, the ways that are only in the change files
+    for wayId, way in sorted(changedWays.items()):
+        addWay(wayId, way)
+
+    wayPtr = numpy.zeros(len(wayLengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(toArray(wayLengths, numpy.int64), out=wayPtr[1:])
+    return nodeIds, nodeLon, nodeLat, toArray(wayIds, numpy.int64), wayPtr, toArray(wayRefs, numpy.int64)
+
+
+def toArray(values, dtype):
+    '''
+    * Turn an array.array into a numpy array (sharing its memory)
+    '''
+    return numpy.frombuffer(values, dtype=dtype) if len(values) else numpy.zeros(0, dtype=dtype)
+
+
+def sortedNodes(ids, lons, lats):
+    '''
+    * Turn the node arrays into numpy arrays, in order of id (OSM files almost always list their nodes that way already)
+    '''
+    nodeIds, lon, lat = toArray(ids, numpy.int64), toArray(lons, numpy.float64), toArray(lats, numpy.float64)
+    if (numpy.diff(nodeIds) <= 0).any():
+        order = numpy.argsort(nodeIds, kind='mergesort')
+        nodeIds, lon, lat = nodeIds[order], lon[order], lat[order]
+    return nodeIds, lon, lat
+
+
+def inside(nodeIds, refs):
+    '''
+    * Return which of the node ids 'refs' are among the (sorted) 'nodeIds'
+    '''
+    refs = numpy.asarray(refs, dtype=numpy.int64)
+    if not len(nodeIds):
+        return numpy.zeros(len(refs), dtype=bool)
+    positions = numpy.minimum(numpy.searchsorted(nodeIds, refs), len(nodeIds) - 1)
+    return nodeIds[positions] == refs
+
+
+def wayEdges(nodeIds, wayPtr, wayRefs):
+    '''
+    * Return an edge from node rows[k] to node cols[k] (positions in 'nodeIds') for each pair of neighbouring nodes along the ways
+    *
+    * A way that leaves the box is cut off at the last node inside it.
+    '''
+    # pair each node of each way with the one after it (but not the last node of one way with the first of the next)
+    last = numpy.zeros(len(wayRefs), dtype=bool)
+    last[wayPtr[1:] - 1] = True
+    u, v = wayRefs[:-1][~last[:-1]], wayRefs[1:][~last[:-1]]
+
+    # find both ends of every edge among the nodes in the box, and drop the edges that leave the box
+    keep = inside(nodeIds, u) & inside(nodeIds, v) & (u != v)
+    return numpy.searchsorted(nodeIds, u[keep]).astype(numpy.int32), numpy.searchsorted(nodeIds, v[keep]).astype(numpy.int32)
+
+
+def usedNodes(nodeIds, lon, lat, rows, cols):
+    '''
+    * Keep only the nodes that the edges use, and renumber the edges to match
+    '''
+    used = numpy.unique(numpy.concatenate((rows, cols)))
+    renumber = numpy.full(len(nodeIds), -1, dtype=numpy.int64)
+    renumber[used] = numpy.arange(len(used))
+    return nodeIds[used].copy(), lon[used].copy(), lat[used].copy(), renumber[rows].astype(numpy.int32), renumber[cols].astype(numpy.int32)
+
+
+def readOsm(path, bbox=None, highways=WALKABLE):
+    '''
+    * Stream through an OSM xml file, and return the walkable network inside 'bbox' (or everywhere) as arrays
+    *
+    * Returns (nodeIds, lon, lat, rows, cols): the OSM ids (sorted) and coordinates of every node a walkable way
+    * passes through, and one edge from node rows[k] to node cols[k] (positions in those arrays) for each pair
+    * of neighbouring nodes along a way. A way that leaves the box is cut off at the last node inside it.
+    '''
+    ids, lon, lat, wayIds, wayPtr, wayRefs = streamOsm(path, bbox, highways)
+    return usedNodes(ids, lon, lat, *wayEdges(ids, wayPtr, wayRefs))
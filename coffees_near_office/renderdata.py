@@ -0,0 +1,202 @@
+'''
+* renderdata.py
+*
+* Prepare the background layers of the map (from 'osm_polygons' and 'osm_lines') for rendering.
+*
+* The raw OSM shapefiles cover the whole of Manchester in WGS84, so every render used to scan all of each
+* file and reproject every feature into the British National Grid on the fly, only to draw the small area
+* around the cafes. Instead, each shapefile is read once, clipped to the area on the map (plus a margin),
+* reprojected to the British National Grid (EPSG:27700, the same as the map) and saved again. Generalised
+* copies are also saved for zoomed-out maps, with geometry simplified to about half a pixel at that scale
+* and features smaller than that left out. Mapnik's 'shapeindex' tool (if it is installed) then builds a
+* spatial index for each of them.
+*
+* The prepared shapefiles are kept in 'output/render', and only prepared again when the raw shapefiles or
+* the area on the map change. The styles in 'mapstyle.json' pick the right copy for the map's scale.
+*
+* To prepare a bigger area (e.g. all of Manchester, for 'tiles.py'), from this folder:
+*
+*   python renderdata.py --bbox 370000 385000 400000 410000
+'''
+
+import argparse, json, os, subprocess
+
+try:
+    from distutils.spawn import find_executable
+except ImportError:
+    from shutil import which as find_executable
+
+import fiona
+from fiona.crs import from_epsg
+from pyproj import Proj, transform
+from shapely.geometry import GeometryCollection, box, mapping, shape
+from shapely.ops import transform as transformGeometry, unary_union
+
+# bump this whenever the way layers are prepared changes, so old copies get prepared again
+PREPARE_VERSION = 1
+
+# the generalised copies saved of each layer: (file name suffix, the smallest scale denominator it is drawn at).
+# these must match the layers' scales in 'mapstyle.json'
+LEVELS = (('', 0), ('_medium', 25000), ('_overview', 100000))
+
+# the size of a pixel on the map, in metres per unit of scale denominator (mapnik assumes 0.28mm pixels)
+PIXEL_SIZE = 0.00028
+
+# how far (in metres) to carry on past the edge of the map, so clipped edges and line ends are never seen
+MARGIN = 250
+
+wgs84 = Proj(init='epsg:4326')
+bng = Proj(init='epsg:27700')
+
+
+def preparedPath(path, outDir, suffix=''):
+    return os.path.join(outDir, os.path.splitext(os.path.basename(path))[0] + suffix + '.shp')
+
+
+def sourceStamp(path):
+    '''
+    * Return the sizes and modification times of the shapefile's geometry and attribute files
+    '''
+    stamp = []
+    for ext in ('.shp', '.dbf'):
+        stat = os.stat(os.path.splitext(path)[0] + ext)
+        stamp.extend([stat.st_size, stat.st_mtime])
+    return stamp
+
+
+def geographicBounds(extent):
+    '''
+    * Return the (minLon, minLat, maxLon, maxLat) box that covers a British National Grid box
+    '''
+    xs = [extent[0], extent[2], extent[2], extent[0]]
+    ys = [extent[1], extent[1], extent[3], extent[3]]
+    lons, lats = transform(bng, wgs84, xs, ys)
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+def mapExtent(bounds, buffer, width, height):
+    '''
+    * Return the British National Grid box a map of 'width' x 'height' pixels shows when zoomed to 'bounds'
+    *
+    * 'bounds' is (minLon, minLat, maxLon, maxLat), and 'buffer' is added around it (in metres). Like mapnik's
+    * zoom_to_box, the box is then widened (about its centre) to the same shape as the map.
+    '''
+    x1, y1 = transform(wgs84, bng, bounds[0], bounds[1])
+    x2, y2 = transform(wgs84, bng, bounds[2], bounds[3])
+    x1, y1, x2, y2 = x1 - buffer, y1 - buffer, x2 + buffer, y2 + buffer
+    cx, cy = (x1 + x2) / 2.0, (y1 + y2) / 2.0
+    halfW, halfH = (x2 - x1) / 2.0, (y2 - y1) / 2.0
+    if halfW / halfH > float(width) / height:
+        halfH = halfW * height / float(width)
+    else:
+        halfW = halfH * width / float(height)
+    return (cx - halfW, cy - halfH, cx + halfW, cy + halfH)
+
+
+def toBng(geometry):
+    return transformGeometry(lambda x, y, z=None: transform(wgs84, bng, x, y), geometry)
+
+
+def sameKind(geometry, geomType):
+    '''
+    * Drop any stray points or lines left over from clipping a polygon (or points from clipping a line)
+    '''
+    if geometry.geom_type != 'GeometryCollection':
+        return geometry
+    kind = geomType.replace('Multi', '')
+    parts = [part for part in geometry.geoms if part.geom_type.replace('Multi', '') == kind]
+    return unary_union(parts) if parts else GeometryCollection()
+
+
+def prepareLayer(path, extent, outDir='output/render'):
+    '''
+    * Clip, reproject and generalise one shapefile, and return the number of features in each prepared copy
+    *
+    * 'extent' is (minX, minY, maxX, maxY) in British National Grid metres.
+    '''
+    area = box(*extent)
+    with fiona.open(path) as src:
+        schema = src.schema
+
+        # fiona only reads the features whose bounds overlap the area (in WGS84)
+        clipped = []
+        for feat in src.filter(bbox=geographicBounds(extent)):
+            if feat['geometry'] is None:
+                continue
+            geometry = toBng(shape(feat['geometry']))
+            if not geometry.intersects(area):
+                continue
+            if not area.contains(geometry):
+                geometry = sameKind(geometry.intersection(area), geometry.geom_type)
+            clipped.append((geometry, feat['properties']))
+
+    counts = {}
+    for suffix, minScale in LEVELS:
+        tolerance = PIXEL_SIZE * minScale / 2.0
+        outPath = preparedPath(path, outDir, suffix)
+        written = 0
+        with fiona.open(outPath, 'w', driver='ESRI Shapefile', crs=from_epsg(27700), schema=schema) as dst:
+            for geometry, properties in clipped:
+                if tolerance:
+                    # leave out anything smaller than the simplification can keep (a pixel or so across)
+                    minX, minY, maxX, maxY = geometry.bounds
+                    if max(maxX - minX, maxY - minY) < tolerance:
+                        continue
+                    geometry = geometry.simplify(tolerance, preserve_topology=True)
+                if geometry.is_empty:
+                    continue
+                dst.write({'geometry': mapping(geometry), 'properties': properties})
+                written += 1
+        counts[os.path.basename(outPath)] = written
+
+        # build mapnik's own spatial index ('<name>.index') for the copy, so it only reads the features on the map
+        if find_executable('shapeindex'):
+            subprocess.call(['shapeindex', '--quiet', outPath])
+    return counts
+
+
+def prepareLayers(paths, extent, outDir='output/render', margin=MARGIN):
+    '''
+    * Prepare each of the shapefiles in 'paths' for a map of 'extent', unless they already have been
+    *
+    * Returns True if anything was prepared, or False if the copies from last time were still up to date.
+    '''
+    extent = (extent[0] - margin, extent[1] - margin, extent[2] + margin, extent[3] + margin)
+    stamp = {'version': PREPARE_VERSION, 'extent': [round(c, 1) for c in extent],
+             'sources': dict((os.path.basename(path), sourceStamp(path)) for path in paths)}
+
+    # the stamp is saved last, so if preparing was interrupted it starts again next time
+    stampPath = os.path.join(outDir, 'prepared.json')
+    if os.path.exists(stampPath):
+        with open(stampPath) as f:
+            if json.load(f).get('stamp') == stamp:
+                return False
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    counts = {}
+    for path in paths:
+        counts.update(prepareLayer(path, extent, outDir))
+    with open(stampPath, 'w') as f:
+        json.dump({'stamp': stamp, 'features': counts}, f, indent=2, sort_keys=True)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clip, reproject and generalise the background layers of the map.')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'), required=True,
+                        help='the area to prepare, in British National Grid metres')
+    parser.add_argument('--out', default='output/render', help='the folder to save the prepared shapefiles in')
+    parser.add_argument('layers', nargs='*', default=['data/osm_polygons.shp', 'data/osm_lines.shp'])
+    args = parser.parse_args()
+
+    if prepareLayers(args.layers, args.bbox, args.out):
+        with open(os.path.join(args.out, 'prepared.json')) as f:
+            for name, count in sorted(json.load(f)['features'].items()):
+                print('%s: %d features' % (name, count))
+    else:
+        print('The prepared layers in %s are already up to date' % args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+'''
+* service.py
+*
+* A small local web service that answers "which cafes are within N minutes' walk of this point?" in milliseconds.
+*
+* Rather than running the whole script for every question, the service loads the walking graph (see
+* 'walkgraph.py') and every cafe in the OSM shapefiles (see 'amenityindex.py') once, and keeps them in memory.
+* Each request then only needs one walk search (see 'walksearch.py') and an array lookup. Requests are
+* answered on their own threads, and the time taken by each one is recorded.
+*
+* Usage (from this folder, like the main script):
+*
+*   python service.py serve --port 8765
+*   python service.py query -2.2345 53.4764 --minutes 10
+*
+* The service understands:
+*
+*   GET /cafes?lon=<lon>&lat=<lat>&minutes=<walk time>   (or &dist=<walk distance in metres>)
+*       the cafes within walking distance, as a GeoJSON FeatureCollection (nearest first), or a 400 error if
+*       there is no street within the snapping distance (200 metres) of the point
+*   GET /metrics
+*       the number of requests answered so far, and their latency in milliseconds
+'''
+
+import argparse, json, sys, threading, time
+from collections import deque
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urllib2 import HTTPError, urlopen
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError
+    from urllib.parse import parse_qs, urlencode, urlparse
+    from urllib.request import urlopen
+
+import numpy
+
+from amenityindex import readAmenity
+from cafestream import centroids, merge
+from walkgraph import changeFiles, loadGraph
+from walksearch import walkSearch
+
+# walking speed in metres per minute: 2.5km in 30 minutes, as in the main script (Naismith's rule, on the flat)
+WALK_SPEED = 2500 / 30.0
+
+# the longest walk (in metres) the service will search for, so one request cannot tie it up for long
+MAX_WALK_DIST = 10000
+
+
+class CafeFinder(object):
+    '''
+    * Keeps the walking graph and all the cafes loaded, and answers walking distance questions about them
+    '''
+
+    def __init__(self, xmlPath='data/manchester.xml', polygons='data/osm_polygons.shp', points='data/osm_points.shp', maxSnapDist=200, bbox=None, changes=None):
+        # the OSM change files are applied to the graph first (by default, the same ones as the main script), and if a 'bbox' is given,
+        # only the streets and cafes inside it are loaded, rather than the whole extract
+        self.graph = loadGraph(xmlPath, None, bbox, None, changeFiles() if changes is None else changes)
+        self.cafes = list(merge(centroids(readAmenity(polygons, 'cafe', bbox)), readAmenity(points, 'cafe', bbox)))
+        self.maxSnapDist = maxSnapDist
+
+        # the cafes get snapped onto each part of the street network the first time a request starts there
+        self._cafePositions = {}
+        self._lock = threading.Lock()
+
+    def cafePositions(self, component):
+        with self._lock:
+            if component not in self._cafePositions:
+                nodes, dists = self.graph.snapNodes([cafe['geometry']['coordinates'] for cafe in self.cafes], component, self.maxSnapDist)
+                self._cafePositions[component] = numpy.array([self.graph.index(n) if n is not None else -1 for n in nodes], dtype=numpy.int64)
+            return self._cafePositions[component]
+
+    def find(self, lon, lat, maxDist):
+        '''
+        * Return a GeoJSON FeatureCollection of the cafes within 'maxDist' metres' walk of (lon, lat), nearest first, or
+        * None if there is no street within 'maxSnapDist' of (lon, lat)
+        *
+        * The walk includes getting from (lon, lat) onto the street network, so it is measured from the point itself.
+        '''
+        nodes, snapDists = self.graph.snapOrigins([(lon, lat)], self.maxSnapDist)
+        origin, snapDist = nodes[0], float(snapDists[0])
+        if origin is None:
+            return None
+        positions = self.cafePositions(self.graph.componentOf(origin))
+
+        tree = walkSearch(self.graph, origin, max(maxDist - snapDist, 0.0))
+        dists = numpy.full(len(positions), numpy.inf)
+        snapped = positions >= 0
+        dists[snapped] = snapDist + tree.dist[positions[snapped]]
+        walkable = numpy.nonzero(dists < maxDist)[0]
+
+        features = []
+        for k in walkable[numpy.argsort(dists[walkable])]:
+            cafe = self.cafes[k]
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': list(cafe['geometry']['coordinates'][:2])},
+                'properties': {
+                    'osm_id': cafe['properties'].get('osm_id'),
+                    'name': cafe['properties'].get('name'),
+                    'walk_dist': round(float(dists[k]), 1),
+                    'walk_minutes': round(float(dists[k]) / WALK_SPEED, 1),
+                },
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+class LatencyMetrics(object):
+    '''
+    * A thread-safe record of how long the most recent requests took
+    '''
+
+    def __init__(self, keep=10000):
+        self.count = 0
+        self.recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.recent.append(seconds * 1000)
+
+    def summary(self):
+        with self._lock:
+            latencies = numpy.array(self.recent)
+            count = self.count
+        if not len(latencies):
+            return {'requests': count}
+        p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+        return {'requests': count, 'mean_ms': round(float(latencies.mean()), 2), 'p50_ms': round(float(p50), 2),
+                'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2), 'max_ms': round(float(latencies.max()), 2)}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    * Answers the '/cafes' and '/metrics' requests (the CafeFinder and LatencyMetrics live on the server)
+    '''
+
+    def do_GET(self):
+        started = time.time()
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+
+        if url.path == '/metrics':
+            self.reply(200, self.server.metrics.summary())
+            return
+        if url.path != '/cafes':
+            self.reply(404, {'error': 'unknown path %s' % url.path})
+            return
+
+        try:
+            lon, lat = float(params['lon']), float(params['lat'])
+            maxDist = float(params['dist']) if 'dist' in params else float(params['minutes']) * WALK_SPEED
+        except (KeyError, ValueError):
+            self.reply(400, {'error': "give 'lon', 'lat', and either 'minutes' or 'dist'"})
+            return
+        if not 0 < maxDist <= MAX_WALK_DIST:
+            self.reply(400, {'error': 'the walk must be between 0 and %d metres' % MAX_WALK_DIST})
+            return
+
+        # (a request that fails is still recorded, and still gets an answer)
+        try:
+            result = self.server.finder.find(lon, lat, maxDist)
+        except Exception as e:
+            status, result = 500, {'error': 'the search failed: %s' % e}
+        else:
+            if result is None:
+                status, result = 400, {'error': 'no street within %g metres of the point' % self.server.finder.maxSnapDist}
+            else:
+                status = 200
+        latency = time.time() - started
+        self.server.metrics.record(latency)
+        self.reply(status, result, {'X-Latency-Ms': '%.2f' % (latency * 1000)})
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/geo+json' if body.get('type') == 'FeatureCollection' else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the terminal quiet: the latency of every request is in '/metrics' instead
+        pass
+
+
+class CafeServer(ThreadingMixIn, HTTPServer):
+    '''
+    * An HTTP server that answers each request on its own thread
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, finder):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.finder = finder
+        self.metrics = LatencyMetrics()
+
+
+def query(lon, lat, minutes=30, dist=None, host='127.0.0.1', port=8765):
+    '''
+    * Ask a running service for the cafes near (lon, lat), and return the GeoJSON it sends back
+    '''
+    params = {'lon': lon, 'lat': lat}
+    if dist is not None:
+        params['dist'] = dist
+    else:
+        params['minutes'] = minutes
+    response = urlopen('http://%s:%d/cafes?%s' % (host, port, urlencode(params)))
+    return json.loads(response.read().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer "which cafes are within N minutes walk?" from a graph kept in memory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve', help='load the graph and cafes, and start answering requests')
+    serve.add_argument('--graph', default='data/manchester.xml', help='the OSM xml file of the street network')
+    serve.add_argument('--polygons', default='data/osm_polygons.shp', help='the OSM polygons shapefile')
+    serve.add_argument('--points', default='data/osm_points.shp', help='the OSM points shapefile')
+    serve.add_argument('--bbox', type=float, nargs=4, metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'), help='only load the streets and cafes in this area (default: the whole extract)')
+
+    ask = commands.add_parser('query', help='ask a running service about a point')
+    ask.add_argument('lon', type=float)
+    ask.add_argument('lat', type=float)
+    ask.add_argument('--minutes', type=float, default=30, help='the walking time (default: 30)')
+    ask.add_argument('--dist', type=float, help='the walking distance in metres (instead of a time)')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = CafeServer((args.host, args.port), CafeFinder(args.graph, args.polygons, args.points, bbox=tuple(args.bbox) if args.bbox else None))
+        print('Serving cafes on http://%s:%d/cafes ...' % (args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    elif args.command == 'query':
+        try:
+            result = query(args.lon, args.lat, args.minutes, args.dist, args.host, args.port)
+        except HTTPError as e:
+            sys.exit(e.read().decode('utf-8'))
+        json.dump(result, sys.stdout, indent=2)
+        print('')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
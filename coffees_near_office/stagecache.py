@@ -0,0 +1,99 @@
+'''
+* stagecache.py
+*
+* Remember what each stage of the main script produced, so a rerun can skip the stages whose inputs have not changed.
+*
+* Each stage gets a 'key': a hash of the content of its input files (including the code that does the work), the
+* parameters it is run with, and the keys of the stages it follows on from (so that a change to one stage ripples
+* down to every stage after it). Once a stage has run, its key is saved along with a few values that later stages
+* need. Next time, if the key is the same and the stage's output files are all still there, it is skipped and the
+* saved values are used instead. Changing the map style, for example, then only re-renders the map, without
+* finding the cafes or their routes again.
+*
+* Files are hashed by their content, but each file's hash is remembered along with its size and modification
+* time, so files that have not been touched are not read again on every run.
+'''
+
+import hashlib, json, os
+
+# bump this whenever the layout of the saved stages changes, so they are all run again
+CACHE_VERSION = 1
+
+
+class StageCache(object):
+    '''
+    * The saved keys and values of each stage, kept as '<stage>.json' in 'cacheDir'
+    '''
+
+    def __init__(self, cacheDir='output/cache', enabled=True):
+        self.cacheDir = cacheDir
+        self.enabled = enabled
+        self._hashesPath = os.path.join(cacheDir, 'hashes.json')
+        self._hashes = {}
+        if os.path.exists(self._hashesPath):
+            with open(self._hashesPath) as f:
+                self._hashes = json.load(f)
+
+    def fileHash(self, path):
+        '''
+        * Return the SHA-1 of a file's content (a shapefile's geometry and attributes, for a '.shp')
+        '''
+        parts = [path]
+        if path.endswith('.shp'):
+            parts.append(path[:-4] + '.dbf')
+
+        hashes = []
+        for part in parts:
+            stat = os.stat(part)
+            known = self._hashes.get(part)
+            if known is None or (known['size'], known['mtime']) != (stat.st_size, stat.st_mtime):
+                h = hashlib.sha1()
+                with open(part, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+                known = self._hashes[part] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': h.hexdigest()}
+            hashes.append(known['sha1'])
+        return ' '.join(hashes)
+
+    def key(self, stage, inputs=(), params=None, after=()):
+        '''
+        * Return the key of a stage run on the files 'inputs', with 'params', after the stages with the keys 'after'
+        '''
+        if not self.enabled:
+            return None
+        h = hashlib.sha1()
+        h.update(json.dumps([CACHE_VERSION, stage, params, list(after)], sort_keys=True).encode('utf-8'))
+        for path in inputs:
+            h.update(('%s %s\n' % (path, self.fileHash(path))).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, stage):
+        return os.path.join(self.cacheDir, stage + '.json')
+
+    def fresh(self, stage, key, outputs=()):
+        '''
+        * Return True if the stage was last run with the same key, and all of its output files are still there
+        '''
+        if not self.enabled or not os.path.exists(self._path(stage)):
+            return False
+        with open(self._path(stage)) as f:
+            saved = json.load(f)
+        return saved['key'] == key and all(os.path.exists(path) for path in outputs)
+
+    def load(self, stage):
+        '''
+        * Return the values saved by the last run of a stage
+        '''
+        with open(self._path(stage)) as f:
+            return json.load(f)['values']
+
+    def save(self, stage, key, values=None):
+        '''
+        * Note that a stage has run (with 'key'), along with any values later stages will need
+        '''
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        with open(self._path(stage), 'w') as f:
+            json.dump({'key': key, 'values': values}, f)
+        with open(self._hashesPath, 'w') as f:
+            json.dump(self._hashes, f)
@@ -0,0 +1,115 @@
+'''
+* steptimer.py
+*
+* Time each step of the main script, and write the timings to a JSON report at the end of each run.
+*
+* For each step, the report has the wall-clock time, the CPU time, the peak memory use of the program so far
+* (its peak resident set size), and any counts the step notes down (cafes found, graph nodes expanded...).
+* This shows which step is the slow one on a given OSM extract. A full cProfile dump of the run can also be
+* saved, to dig into a slow step; read it with:
+*
+*   python -m pstats output/timings.pstats
+*
+* When it is switched off, every call returns straight away, so the timer can be left in place.
+'''
+
+import cProfile, json, os, sys, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def cpuTime():
+    '''
+    * Return the CPU time (user and system) used by this process so far, in seconds
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peakMemory():
+    '''
+    * Return the peak resident set size of this process so far, in MB (or 0 where it cannot be measured)
+    '''
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux measures this in kilobytes, but macOS in bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class StepTimer(object):
+    '''
+    * Records how long each step takes, one after another
+    *
+    * start(name) ends the step before it (if any) and starts timing the next, so the main script only needs one
+    * line at the start of each step.
+    '''
+
+    def __init__(self, enabled=True, profile=False):
+        self.enabled = enabled
+        self.steps = []
+        self.extra = {}
+        self._current = None
+        self._started = (time.time(), cpuTime())
+        self._profiler = None
+        if enabled and profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        self._current = {'name': name, 'counts': {}, 'started': (time.time(), cpuTime())}
+
+    def count(self, key, n=1):
+        '''
+        * Add 'n' to one of the current step's counts
+        '''
+        if self._current is not None:
+            counts = self._current['counts']
+            counts[key] = counts.get(key, 0) + n
+
+    def attach(self, key, value):
+        '''
+        * Add anything else worth keeping (e.g. the timings of the task graph) to the report, as 'key'
+        '''
+        if self.enabled:
+            self.extra[key] = value
+
+    def stop(self):
+        step, self._current = self._current, None
+        if step is None:
+            return
+        wall, cpu = step.pop('started')
+        step['wall_s'] = round(time.time() - wall, 4)
+        step['cpu_s'] = round(cpuTime() - cpu, 4)
+        step['peak_rss_mb'] = round(peakMemory(), 1)
+        self.steps.append(step)
+
+    def report(self, path='output/timings.json', profilePath='output/timings.pstats'):
+        '''
+        * End the last step, write the report (and the cProfile dump, if profiling), and return the report
+        '''
+        if not self.enabled:
+            return None
+        self.stop()
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(profilePath)
+
+        report = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started[0])),
+            'wall_s': round(time.time() - self._started[0], 4),
+            'cpu_s': round(cpuTime() - self._started[1], 4),
+            'peak_rss_mb': round(peakMemory(), 1),
+            'steps': self.steps,
+        }
+        report.update(self.extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return report
@@ -0,0 +1,198 @@
+'''
+* taskgraph.py
+*
+* Run the parts of the script that don't depend on each other at the same time, as a small graph of tasks.
+*
+* Each task names the tasks it depends on, and is started as soon as they have all finished (their results are
+* handed to it). Tasks that spend most of their time waiting on files, like reading shapefiles with fiona, run
+* on threads. Tasks that keep a processor busy, like parsing the OSM xml and compiling the walking graph, run in
+* their own processes, so Python's global interpreter lock doesn't hold them back (their functions and results
+* must be picklable). Once everything has finished, the 'critical path' (the chain of dependent tasks that took
+* the longest) shows which branch the whole graph was waiting for.
+'''
+
+import sys, time, traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+# how often (in seconds) to check on the running tasks while waiting for one to finish, which also lets Ctrl-C through on Python 2
+POLL_SECONDS = 0.1
+
+
+class TaskError(Exception):
+    pass
+
+
+def runTask(func, args):
+    '''
+    * Run one task, and return (True, its result, start time, end time), or (False, the error, start time, end time)
+    '''
+    started = time.time()
+    try:
+        return True, func(*args), started, time.time()
+    except Exception:
+        return False, traceback.format_exc(), started, time.time()
+
+
+def failure(error):
+    '''
+    * Return the outcome (as 'runTask' would) of a task that could not be run at all, e.g. as it could not be sent to a process
+    '''
+    now = time.time()
+    return False, ''.join(traceback.format_exception_only(type(error), error)), now, now
+
+
+def submit(pool, name, func, args, finished):
+    '''
+    * Start a task on a pool, and put (name, its outcome) on the 'finished' queue once it is done, or could not be run
+    '''
+    done = lambda outcome: finished.put((name, outcome))
+    if sys.version_info[0] < 3:
+        # (Python 2's pools have no 'error_callback', so 'TaskGraph.run' checks on these tasks itself)
+        return pool.apply_async(runTask, (func, args), callback=done)
+    return pool.apply_async(runTask, (func, args), callback=done, error_callback=lambda error: finished.put((name, failure(error))))
+
+
+class TaskGraph(object):
+    '''
+    * A set of tasks and the tasks each one depends on
+    *
+    * A task can only depend on tasks added before it, so the graph can never go round in a circle.
+    '''
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.tasks = {}
+        self.order = []
+        self.results = {}
+        self.times = {}
+        self.wall = 0.0
+
+    def add(self, name, func, args=(), deps=(), kind='thread'):
+        '''
+        * Add a task, which calls func(results of 'deps'..., *args) on a thread ('thread') or in a process ('process')
+        '''
+        if kind not in ('thread', 'process'):
+            raise ValueError("a task's kind must be 'thread' or 'process', not %r" % kind)
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('%s depends on %s, which has not been added yet' % (name, dep))
+        self.tasks[name] = {'func': func, 'args': tuple(args), 'deps': tuple(deps), 'kind': kind}
+        self.order.append(name)
+
+    def run(self):
+        '''
+        * Run every task, as many at once as their dependencies allow, and return a dict of their results
+        *
+        * If a task fails (or could not be sent to its process, or its process died), nothing new is started, and
+        * a TaskError (with the task's traceback) is raised once the tasks already running have finished.
+        '''
+        finished = Queue()
+        started = time.time()
+
+        # the processes are started before any threads, as forking a process that already has threads running is unsafe
+        processes = sum(1 for name in self.order if self.tasks[name]['kind'] == 'process')
+        processPool = Pool(processes) if processes else None
+        threadPool = ThreadPool(self.threads)
+
+        # note the pool's worker processes, to notice if one dies: the pool would quietly start another in its place, and the task
+        # it was running would never finish
+        workers = set(worker.pid for worker in processPool._pool) if processPool is not None else set()
+
+        waiting, running, failed, handles, broken, clean = list(self.order), 0, None, {}, False, False
+        try:
+            while waiting or running:
+                if failed is None:
+                    for name in [n for n in waiting if all(dep in self.results for dep in self.tasks[n]['deps'])]:
+                        task = self.tasks[name]
+                        args = tuple(self.results[dep] for dep in task['deps']) + task['args']
+                        pool = processPool if task['kind'] == 'process' else threadPool
+                        handles[name] = submit(pool, name, task['func'], args, finished)
+                        waiting.remove(name)
+                        running += 1
+                if not running:
+                    break
+
+                # wait for the next task to finish, checking every so often for any that never will
+                try:
+                    name, (ok, value, start, end) = finished.get(timeout=POLL_SECONDS)
+                except Empty:
+                    for name, handle in list(handles.items()):
+                        if sys.version_info[0] < 3 and handle.ready() and not handle.successful():
+                            try:
+                                handle.get()
+                            except Exception as error:
+                                finished.put((name, failure(error)))
+                    if processPool is not None and not broken and set(worker.pid for worker in processPool._pool) != workers:
+                        # (there is no telling which of the process tasks running at the time it was, so they all count as failed)
+                        broken = True
+                        for name in [n for n in handles if self.tasks[n]['kind'] == 'process']:
+                            finished.put((name, failure(TaskError('a worker process died while this task (or another process task) was running'))))
+                    continue
+
+                # (a task is only counted once: one that was given up on above may still finish later on)
+                if handles.pop(name, None) is None:
+                    continue
+                running -= 1
+                self.times[name] = (start - started, end - started)
+                if ok:
+                    self.results[name] = value
+                elif failed is None:
+                    failed = (name, value)
+            clean = True
+        finally:
+            threadPool.close()
+            threadPool.join()
+
+            # (a pool that lost a worker, or was interrupted, still has tasks that will never finish, so it has to be stopped)
+            if processPool is not None:
+                if clean and not broken:
+                    processPool.close()
+                else:
+                    processPool.terminate()
+                processPool.join()
+
+        self.wall = time.time() - started
+        if failed is not None:
+            raise TaskError('the %s task failed:\n%s' % failed)
+        return self.results
+
+    def criticalPath(self):
+        '''
+        * Return the names of the tasks on the longest chain of dependent tasks (in order), and how long it took altogether
+        '''
+        longest = {}
+        for name in self.order:
+            if name not in self.times:
+                continue
+            start, end = self.times[name]
+            before = max([longest[dep] for dep in self.tasks[name]['deps'] if dep in longest] or [(0.0, [])])
+            longest[name] = (before[0] + end - start, before[1] + [name])
+        if not longest:
+            return [], 0.0
+        total, path = max(longest.values())
+        return path, total
+
+    def summary(self):
+        '''
+        * Return when each task started and finished (in seconds after the graph started), and the critical path
+        '''
+        path, total = self.criticalPath()
+        tasks = []
+        for name in self.order:
+            if name in self.times:
+                start, end = self.times[name]
+                tasks.append({'name': name, 'kind': self.tasks[name]['kind'], 'deps': list(self.tasks[name]['deps']),
+                              'start_s': round(start, 4), 'end_s': round(end, 4)})
+        return {
+            'wall_s': round(self.wall, 4),
+            'one_after_another_s': round(sum(end - start for start, end in self.times.values()), 4),
+            'critical_path': path,
+            'critical_path_s': round(total, 4),
+            'tasks': tasks,
+        }
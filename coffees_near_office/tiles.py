@@ -0,0 +1,286 @@
+'''
+* tiles.py
+*
+* Render the cafe map as 256px 'slippy map' tiles (z/x/y, in web mercator), for viewing in a web map.
+*
+* The map itself (all of the styles and layers from Steps 6-8) is not rebuilt here: the main script saves it
+* as a mapnik XML file ('output/cafes_map.xml'), and this loads it. Tiles are rendered in 'metatiles' of
+* 8x8 tiles at a time, which cuts down the work mapnik repeats at tile edges and stops labels and icons being
+* chopped in half, and then cut up into single tiles. Tiles are kept in a folder tree ('<z>/<x>/<y>.png'),
+* and re-rendered once they are older than the expiry time. The server keeps a fixed number of mapnik maps
+* loaded, and a tile that is already in the cache is sent straight from it, without using one of them.
+*
+* The background layers are the clipped copies prepared by 'renderdata.py', which only cover the area on the
+* main script's map; to make tiles of a bigger area, prepare that area first (see 'renderdata.py').
+*
+* Usage (from this folder, like the main script, after it has been run once):
+*
+*   python tiles.py seed --zoom 12 17 --processes 4      (render every tile over Manchester, ahead of time)
+*   python tiles.py serve --port 8766 --renderers 4     (serve http://localhost:8766/<z>/<x>/<y>.png)
+'''
+
+import argparse, math, os, threading, time
+from multiprocessing import Pool, cpu_count
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+
+import fiona
+import mapnik
+
+# the size of a single tile, and the number of tiles along each side of a metatile
+TILE_SIZE = 256
+METATILE = 8
+
+# the web mercator projection used by slippy maps, and half the width of the world in it (in metres)
+MERCATOR = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0.0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs +over'
+HALF_WORLD = math.pi * 6378137
+
+# the renderer each seeding worker process uses, set up once per process by 'initWorker'
+_shared = {}
+
+
+def lonLatToTile(lon, lat, z):
+    '''
+    * Return the (x, y) of the tile at zoom 'z' that contains (lon, lat)
+    '''
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tileBounds(x, y, z, span=1):
+    '''
+    * Return the web mercator box covered by the 'span' x 'span' block of tiles whose top-left tile is (x, y)
+    '''
+    size = 2 * HALF_WORLD / 2 ** z
+    return mapnik.Box2d(-HALF_WORLD + x * size, HALF_WORLD - (y + span) * size, -HALF_WORLD + (x + span) * size, HALF_WORLD - y * size)
+
+
+class TileCache(object):
+    '''
+    * The folder tree of tiles, and which metatile each tile is cut from (this needs no mapnik map, so it is quick to make)
+    '''
+
+    def __init__(self, cacheDir='output/tiles', metatile=METATILE, maxAge=7 * 24 * 3600):
+        self.cacheDir = cacheDir
+        self.metatile = metatile
+        self.maxAge = maxAge
+
+    def tilePath(self, z, x, y):
+        return os.path.join(self.cacheDir, str(z), str(x), '%d.png' % y)
+
+    def isFresh(self, z, x, y):
+        path = self.tilePath(z, x, y)
+        return os.path.exists(path) and time.time() - os.path.getmtime(path) < self.maxAge
+
+    def metatileOf(self, z, x, y):
+        return x // self.metatile, y // self.metatile
+
+    def tilesOf(self, z, mx, my):
+        '''
+        * Return the (x, y) of every tile in metatile (mx, my) (fewer than 8x8 at the lowest zoom levels)
+        '''
+        span = min(self.metatile, 2 ** z)
+        return [(mx * span + i, my * span + j) for i in range(span) for j in range(span)]
+
+    def read(self, z, x, y):
+        with open(self.tilePath(z, x, y), 'rb') as f:
+            return f.read()
+
+
+class TileRenderer(TileCache):
+    '''
+    * Renders metatiles of the cafe map, and keeps the tiles cut from them in the cache
+    '''
+
+    def __init__(self, mapXml='output/cafes_map.xml', cacheDir='output/tiles', metatile=METATILE, maxAge=7 * 24 * 3600, bufferSize=128):
+        TileCache.__init__(self, cacheDir, metatile, maxAge)
+        self.map = mapnik.Map(TILE_SIZE * metatile, TILE_SIZE * metatile)
+
+        # the shapefiles in the XML are relative to this folder (where the main script runs), not to the XML's own folder
+        mapnik.load_map(self.map, mapXml, False, os.path.abspath('.'))
+        self.map.srs = MERCATOR
+        self.map.buffer_size = bufferSize
+
+    def renderMetatile(self, z, mx, my):
+        '''
+        * Render one metatile in a single pass, and cut it up into tiles in the cache
+        '''
+        span = min(self.metatile, 2 ** z)
+        self.map.resize(TILE_SIZE * span, TILE_SIZE * span)
+        self.map.zoom_to_box(tileBounds(mx * span, my * span, z, span))
+        image = mapnik.Image(TILE_SIZE * span, TILE_SIZE * span)
+        mapnik.render(self.map, image)
+
+        for x, y in self.tilesOf(z, mx, my):
+            path = self.tilePath(z, x, y)
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+
+            # write to a temporary file first, so a half-written tile is never served
+            data = image.view((x - mx * span) * TILE_SIZE, (y - my * span) * TILE_SIZE, TILE_SIZE, TILE_SIZE).tostring('png')
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+
+    def tile(self, z, x, y):
+        '''
+        * Return the PNG data of tile (z, x, y), rendering its metatile first if it is missing or has expired
+        '''
+        if not self.isFresh(z, x, y):
+            self.renderMetatile(z, *self.metatileOf(z, x, y))
+        return self.read(z, x, y)
+
+
+def metatilesCovering(bbox, zooms, metatile=METATILE):
+    '''
+    * Return every (z, mx, my) metatile needed to cover 'bbox' (minLon, minLat, maxLon, maxLat) at each zoom level
+    '''
+    metatiles = []
+    for z in zooms:
+        span = min(metatile, 2 ** z)
+        x1, y1 = lonLatToTile(bbox[0], bbox[3], z)
+        x2, y2 = lonLatToTile(bbox[2], bbox[1], z)
+        for mx in range(x1 // span, x2 // span + 1):
+            for my in range(y1 // span, y2 // span + 1):
+                metatiles.append((z, mx, my))
+    return metatiles
+
+
+def initWorker(mapXml, cacheDir, maxAge):
+    _shared['renderer'] = TileRenderer(mapXml, cacheDir, maxAge=maxAge)
+
+
+def seedMetatile(metatile):
+    '''
+    * Render one metatile in a worker process, unless all of its tiles are still fresh
+    '''
+    renderer = _shared['renderer']
+    z, mx, my = metatile
+    if not all(renderer.isFresh(z, x, y) for x, y in renderer.tilesOf(z, mx, my)):
+        renderer.renderMetatile(z, mx, my)
+        return 1
+    return 0
+
+
+def seed(bbox, zooms, mapXml='output/cafes_map.xml', cacheDir='output/tiles', maxAge=7 * 24 * 3600, processes=None):
+    '''
+    * Render every metatile over 'bbox' at each zoom level, spread over a pool of worker processes
+    '''
+    metatiles = metatilesCovering(bbox, zooms)
+    workers = processes or cpu_count()
+    pool = Pool(workers, initializer=initWorker, initargs=(mapXml, cacheDir, maxAge))
+    try:
+        rendered = sum(pool.imap_unordered(seedMetatile, metatiles))
+    finally:
+        pool.close()
+        pool.join()
+    return rendered, len(metatiles)
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    '''
+    * Serves '/<z>/<x>/<y>.png', rendering tiles the first time they are asked for
+    '''
+
+    def do_GET(self):
+        try:
+            z, x, y = self.path.strip('/').replace('.png', '').split('/')
+            z, x, y = int(z), int(x), int(y)
+        except ValueError:
+            self.send_error(404)
+            return
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            self.send_error(404)
+            return
+
+        # a tile that is already in the cache is sent straight away. Otherwise, only one thread renders any one metatile at a
+        # time (so the others wait for it, and then find their tiles in the cache too), borrowing one of the server's maps to do it
+        cache = self.server.cache
+        if not cache.isFresh(z, x, y):
+            with self.server.lockFor((z,) + cache.metatileOf(z, x, y)):
+                if not cache.isFresh(z, x, y):
+                    renderer = self.server.renderers.get()
+                    try:
+                        renderer.renderMetatile(z, *cache.metatileOf(z, x, y))
+                    finally:
+                        self.server.renderers.put(renderer)
+        data = cache.read(z, x, y)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mapXml, cacheDir, maxAge, renderers=4):
+        HTTPServer.__init__(self, address, TileHandler)
+        self.cache = TileCache(cacheDir, maxAge=maxAge)
+
+        # a fixed pool of mapnik maps, each loaded once, which the request threads take turns to render with
+        # (every request gets a new thread, so a map per thread would be loaded again for every request)
+        self.renderers = Queue()
+        for i in range(renderers):
+            self.renderers.put(TileRenderer(mapXml, cacheDir, maxAge=maxAge))
+        self._locks = {}
+        self._locksLock = threading.Lock()
+
+    def lockFor(self, metatile):
+        with self._locksLock:
+            return self._locks.setdefault(metatile, threading.Lock())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the cafe map as z/x/y tiles.')
+    parser.add_argument('--map', default='output/cafes_map.xml', help='the mapnik XML file saved by the main script')
+    parser.add_argument('--cache', default='output/tiles', help='the folder to keep the tiles in')
+    parser.add_argument('--max-age', type=float, default=7 * 24, help='re-render tiles older than this many hours (default: a week)')
+    commands = parser.add_subparsers(dest='command')
+
+    seeder = commands.add_parser('seed', help='render all of the tiles over an area ahead of time')
+    seeder.add_argument('--zoom', type=int, nargs=2, default=[12, 17], metavar=('MIN', 'MAX'))
+    seeder.add_argument('--bbox', type=float, nargs=4, metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'), help='(default: the extent of data/osm_polygons.shp)')
+    seeder.add_argument('--processes', type=int, help='the number of worker processes (default: one per core)')
+
+    server = commands.add_parser('serve', help='serve tiles over HTTP, rendering any that are missing')
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=8766)
+    server.add_argument('--renderers', type=int, default=4, help='the number of mapnik maps to keep loaded, i.e. the most metatiles rendered at once (default: 4)')
+    args = parser.parse_args()
+    maxAge = args.max_age * 3600
+
+    if args.command == 'seed':
+        bbox = args.bbox
+        if bbox is None:
+            with fiona.open('data/osm_polygons.shp') as src:
+                bbox = src.bounds
+        started = time.time()
+        rendered, total = seed(bbox, range(args.zoom[0], args.zoom[1] + 1), args.map, args.cache, maxAge, args.processes)
+        print('Rendered %d of %d metatiles in %.1f seconds' % (rendered, total, time.time() - started))
+    elif args.command == 'serve':
+        print('Serving tiles on http://%s:%d/{z}/{x}/{y}.png ...' % (args.host, args.port))
+        TileServer((args.host, args.port), args.map, args.cache, maxAge, args.renderers).serve_forever()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
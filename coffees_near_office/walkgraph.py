@@ -0,0 +1,641 @@
+'''
+* walkgraph.py
+*
+* A compiled, cached copy of the walking graph that Jonny's osm2nx code builds from an OSM xml file.
+*
+* Parsing a city-sized xml file into networkx is by far the slowest part of starting up, so the first time a
+* file is read, the graph is flattened into plain numpy arrays (node ids and coordinates, plus every edge and
+* its length on the Airy ellipsoid, in 'compressed sparse row' form) and saved next to the xml. Later runs
+* memory-map those arrays straight back in, and only go back to the xml if it has actually changed. (The one
+* thing that is not saved is the KD-tree used to snap points onto the graph: it is built in memory the first
+* time anything is snapped, which takes about a tenth of a second per 300,000 nodes.)
+*
+* For an extract too big for networkx, the walkable streets in just one area can be streamed out of the xml
+* instead (see 'osmstream.py'), and compiled into a snapshot of their own. OSM change files can then be applied
+* to that snapshot as they come out (see 'osmchange.py'), rather than reading the whole xml again.
+'''
+
+import glob, hashlib, json, os, shutil
+import numpy
+from pyproj import Geod
+from osmstream import WALKABLE, inBbox, inside, streamOsm, usedNodes, wayEdges, widenBbox
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import connected_components
+
+# bump this whenever the layout of the snapshot files changes, so old snapshots get rebuilt
+SNAPSHOT_VERSION = 5
+
+# the mean radius of the Earth in metres, used to turn degrees into (approximate) metres for snapping
+EARTH_RADIUS = 6371008.8
+
+# the arrays that make up a snapshot (each one is saved as '<name>.npy')
+ARRAYS = ('nodeIds', 'lon', 'lat', 'indptr', 'indices', 'edgeDist', 'component')
+
+# the arrays streamed out of the xml that a streamed snapshot also keeps, so change files can be applied to it (see 'osmstream.py')
+SOURCE_ARRAYS = ('ids', 'lon', 'lat', 'wayIds', 'wayPtr', 'wayRefs')
+
+
+def localMetres(lon, lat, midLat):
+    '''
+    * Turn lon/lat arrays into approximate metres, using an equirectangular projection about the latitude 'midLat'
+    '''
+    x = numpy.radians(numpy.asarray(lon, dtype=numpy.float64)) * numpy.cos(numpy.radians(midLat)) * EARTH_RADIUS
+    y = numpy.radians(numpy.asarray(lat, dtype=numpy.float64)) * EARTH_RADIUS
+    return numpy.column_stack((x, y))
+
+
+class WalkGraph(object):
+    '''
+    * The walking graph, stored as flat arrays
+    *
+    * Node i has the OSM id nodeIds[i] (sorted, so ids can be found with a binary search) and sits at
+    * (lon[i], lat[i]). The edges leaving node i go to indices[indptr[i]:indptr[i+1]], and are
+    * edgeDist[indptr[i]:indptr[i+1]] metres long. component[i] labels the connected part of the network
+    * that node i belongs to, so two nodes with different labels can never be walked between.
+    '''
+
+    def __init__(self, nodeIds, lon, lat, indptr, indices, edgeDist, component):
+        self.nodeIds = nodeIds
+        self.lon = lon
+        self.lat = lat
+        self.indptr = indptr
+        self.indices = indices
+        self.edgeDist = edgeDist
+        self.component = component
+        self._matrix = None
+        self._kdtree = None
+        self._largest = None
+
+    def __len__(self):
+        return len(self.nodeIds)
+
+    def index(self, nodeId):
+        '''
+        * Return the array position of the node with the OSM id 'nodeId' (as a string or a number)
+        '''
+        i = int(numpy.searchsorted(self.nodeIds, int(nodeId)))
+        if i == len(self.nodeIds) or self.nodeIds[i] != int(nodeId):
+            raise KeyError(nodeId)
+        return i
+
+    def nodeId(self, i):
+        '''
+        * Return the OSM id of the node at array position 'i', as the string osm2nx uses for its graph
+        '''
+        return str(self.nodeIds[i])
+
+    def coordinates(self, nodeId):
+        i = self.index(nodeId)
+        return float(self.lon[i]), float(self.lat[i])
+
+    def componentOf(self, nodeId):
+        return int(self.component[self.index(nodeId)])
+
+    def connected(self, a, b):
+        '''
+        * Return whether there could be a path between nodes 'a' and 'b' (i.e. they are in the same component)
+        '''
+        return self.componentOf(a) == self.componentOf(b)
+
+    def _project(self, lon, lat):
+        '''
+        * Turn lon/lat arrays into approximate metres (an equirectangular projection about the middle of the graph)
+        '''
+        return localMetres(lon, lat, (float(self.lat.min()) + float(self.lat.max())) / 2)
+
+    def kdtree(self):
+        '''
+        * Return a KD-tree of the node coordinates (in approximate metres), built the first time it is needed
+        *
+        * The tree is split at the middle of each box rather than at the median node, which builds it about twice as
+        * quickly, and makes no difference to how quickly it answers the nearest-node questions asked of it here.
+        '''
+        if self._kdtree is None:
+            self._kdtree = cKDTree(self._project(self.lon, self.lat), balanced_tree=False, compact_nodes=False)
+        return self._kdtree
+
+    def snapNodes(self, coords, component=None, maxSnapDist=numpy.inf):
+        '''
+        * Snap a whole list (or array) of (lon, lat) points onto the graph at once
+        *
+        * Returns a list of node ids and an array of snapping distances in metres. If 'component' is given,
+        * only nodes in that component are used, so points are not snapped onto little isolated fragments
+        * of footpath. Points with no suitable node within 'maxSnapDist' metres get None instead of a node
+        * id (and an infinite distance), so the caller can report them.
+        '''
+        coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+        positions = numpy.full(len(coords), -1, dtype=numpy.int64)
+        dists = numpy.full(len(coords), numpy.inf)
+        if not len(self):
+            return [None] * len(coords), dists
+        points = self._project(*coords.T)
+
+        # ask the KD-tree for the nearest few nodes of every point at once. Points whose nearest nodes are all in
+        # the wrong component are asked again with a bigger batch, until there is nothing left within reach
+        todo = numpy.arange(len(points))
+        k = 1 if component is None else 8
+        while len(todo):
+            k = min(k, len(self))
+            d, i = self.kdtree().query(points[todo], k=k, distance_upper_bound=maxSnapDist)
+            d, i = d.reshape(len(todo), k), i.reshape(len(todo), k)
+
+            # missing neighbours (further than 'maxSnapDist') come back with a position one past the last node
+            ok = i < len(self)
+            if component is not None:
+                ok &= self.component[numpy.minimum(i, len(self) - 1)] == component
+            found = ok.any(axis=1)
+            first = ok.argmax(axis=1)
+            positions[todo[found]] = i[found, first[found]]
+            dists[todo[found]] = d[found, first[found]]
+
+            exhausted = (i[:, -1] == len(self)) | (k == len(self))
+            todo = todo[~found & ~exhausted]
+            k *= 4
+
+        return [self.nodeId(p) if p >= 0 else None for p in positions], dists
+
+    def nearestNode(self, x, y, component=None):
+        '''
+        * Return the id of the node nearest to (x, y), optionally only from the nodes in 'component'
+        '''
+        nodes, dists = self.snapNodes([(x, y)], component)
+        return nodes[0]
+
+    def largestComponent(self):
+        '''
+        * Return the label of the component with the most nodes (the main street network), or -1 if the graph is empty
+        '''
+        if self._largest is None:
+            self._largest = int(numpy.bincount(self.component).argmax()) if len(self) else -1
+        return self._largest
+
+    def snapOrigins(self, coords, maxSnapDist=numpy.inf):
+        '''
+        * Snap a list of (lon, lat) points that walks start from (like Jonny's office) onto the graph at once
+        *
+        * Each point is snapped to the nearest node on the main street network (the largest component) if there is one
+        * within 'maxSnapDist' metres, so a walk never starts on a little cut-off bit of footpath that reaches nothing
+        * just because it happens to be a few metres closer. Otherwise, it is snapped to the nearest node of any component
+        * within 'maxSnapDist', and points with no node at all that close get None (and an infinite distance), like 'snapNodes'.
+        '''
+        nodes, dists = self.snapNodes(coords, self.largestComponent(), maxSnapDist)
+        missing = [k for k, node in enumerate(nodes) if node is None]
+        if missing:
+            others, otherDists = self.snapNodes([coords[k] for k in missing], None, maxSnapDist)
+            for k, node, dist in zip(missing, others, otherDists):
+                nodes[k], dists[k] = node, dist
+        return nodes, dists
+
+    def originNode(self, x, y, maxSnapDist=numpy.inf):
+        '''
+        * Return the id of the node that a walk from (x, y) starts at, or None if there is none within 'maxSnapDist' (see 'snapOrigins')
+        '''
+        nodes, dists = self.snapOrigins([(x, y)], maxSnapDist)
+        return nodes[0]
+
+    def lineCoordinates(self, path):
+        '''
+        * Return the [lon, lat] coordinates of each node in 'path' (a list of node ids), ready to make a LineString
+        '''
+        positions = numpy.searchsorted(self.nodeIds, numpy.array([int(n) for n in path], dtype=numpy.int64))
+        return numpy.column_stack((self.lon[positions], self.lat[positions])).tolist()
+
+    def matrix(self):
+        '''
+        * Return the graph as a scipy sparse matrix (sharing the same arrays), for scipy.sparse.csgraph
+        '''
+        if self._matrix is None:
+            n = len(self)
+            self._matrix = csr_matrix((self.edgeDist, self.indices, self.indptr), shape=(n, n), copy=False)
+        return self._matrix
+
+
+def compileGraph(G):
+    '''
+    * Flatten a networkx graph made by osm2nx (nodes with 'lon' and 'lat') into a WalkGraph
+    '''
+    nodeData = dict(G.nodes(data=True))
+    keys = sorted(nodeData, key=int)
+    position = dict((key, i) for i, key in enumerate(keys))
+
+    nodeIds = numpy.array([int(key) for key in keys], dtype=numpy.int64)
+    lon = numpy.array([nodeData[key]['lon'] for key in keys], dtype=numpy.float64)
+    lat = numpy.array([nodeData[key]['lat'] for key in keys], dtype=numpy.float64)
+    rows = numpy.array([position[u] for u, v in G.edges()], dtype=numpy.int32)
+    cols = numpy.array([position[v] for u, v in G.edges()], dtype=numpy.int32)
+    return compileArrays(nodeIds, lon, lat, rows, cols, G.is_directed())
+
+
+def compileArrays(nodeIds, lon, lat, rows, cols, directed=False):
+    '''
+    * Build a WalkGraph from sorted node ids and coordinates, and edges from node rows[k] to node cols[k]
+    *
+    * Unless the edges are 'directed', each one can be walked both ways. Every edge's length is measured with the
+    * Inverse Vincenty method on the Airy ellipsoid (the same measure Step 4 has always used for its paths), in one
+    * batch over all of the edges.
+    '''
+    if not directed:
+        rows, cols = numpy.concatenate((rows, cols)), numpy.concatenate((cols, rows))
+    graph = assembleGraph(nodeIds, lon, lat, rows, cols, measureEdges(lon, lat, rows, cols))
+
+    # label the connected components once, here, so that reachability checks are just a comparison later on
+    # (osm2nx graphs are undirected, so these are exact; for a directed graph different labels still mean 'unreachable')
+    count, labels = connected_components(graph.matrix(), directed=True, connection='weak')
+    graph.component = labels.astype(numpy.int32)
+    return graph
+
+
+def measureEdges(lon, lat, rows, cols):
+    '''
+    * Return the length in metres of each edge from node rows[k] to node cols[k], all at once (pyproj works on whole arrays)
+    '''
+    if not len(rows):
+        return numpy.zeros(0)
+    azF, azB, dists = Geod(ellps='airy').inv(lon[rows], lat[rows], lon[cols], lat[cols])
+    return numpy.asarray(dists, dtype=numpy.float64)
+
+
+def assembleGraph(nodeIds, lon, lat, rows, cols, dists):
+    '''
+    * Build a WalkGraph (without its component labels) from edges that have already been measured
+    '''
+    # sort the edges by 'from' node, and keep only the shortest of any duplicated edges
+    order = numpy.lexsort((dists, cols, rows))
+    rows, cols, dists = rows[order], cols[order], dists[order]
+    keep = numpy.ones(len(rows), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, dists = rows[keep], cols[keep], dists[keep]
+
+    indptr = numpy.zeros(len(nodeIds) + 1, dtype=numpy.int32)
+    numpy.cumsum(numpy.bincount(rows, minlength=len(nodeIds)), out=indptr[1:])
+    return WalkGraph(nodeIds, lon, lat, indptr, cols, dists, None)
+
+
+def rowEntries(indptr, rows):
+    '''
+    * Return the positions (in 'indices' and 'edgeDist') of every edge leaving each of the nodes 'rows', row by row
+    '''
+    starts, lengths = indptr[rows].astype(numpy.int64), numpy.diff(indptr)[rows].astype(numpy.int64)
+    offsets = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+    return offsets + numpy.arange(len(offsets)), lengths
+
+
+def patchGraph(graph, dirty, rowIds, colIds, dists, nodes):
+    '''
+    * Return a WalkGraph with the edges at the 'dirty' nodes replaced by the edges (rowIds[k], colIds[k]), dists[k] metres long
+    *
+    * The new edges are given as pairs of OSM node ids, each once (they can be walked both ways), and 'nodes' gives the
+    * (ids, lon, lat) of every node they might use. Nodes that are left without any edges are dropped, and nodes that
+    * gain their first are added. Only the rows of the dirty nodes and of their old and new neighbours are built again:
+    * the rest of the edges are copied across as they are, with a single pass over the arrays to make room for the new
+    * ones. The component labels are only worked out again if an edge or a node was taken away (and then only for the
+    * components it was in); otherwise new edges just merge the components they join. Any array that has not changed
+    * is used as it is, not copied, and if nothing changed at all, 'graph' itself is returned.
+    '''
+    ids, lon, lat = nodes
+    n = len(graph)
+    dirty = numpy.asarray(dirty, dtype=numpy.int64)
+    rowIds, colIds = numpy.asarray(rowIds, dtype=numpy.int64), numpy.asarray(colIds, dtype=numpy.int64)
+    indptr = numpy.asarray(graph.indptr)
+
+    ## the 'touched' rows: the dirty nodes, their old neighbours, and both ends of the new edges
+    dirtyRows = numpy.searchsorted(graph.nodeIds, dirty)[inside(graph.nodeIds, dirty)]
+    entries, lengths = rowEntries(indptr, dirtyRows)
+    touchedIds = numpy.unique(numpy.concatenate((dirty, graph.nodeIds[graph.indices[entries]], rowIds, colIds)))
+    inGraph = inside(graph.nodeIds, touchedIds)
+    touched = numpy.searchsorted(graph.nodeIds, touchedIds[inGraph])
+
+    # their old edges (as ids, in order of 'from' node and then 'to' node, like the graph itself), and their new ones: the old
+    # ones that don't touch a dirty node, and the new edges in both directions, keeping only the shortest of any duplicates
+    entries, lengths = rowEntries(indptr, touched)
+    oldRows = numpy.repeat(graph.nodeIds[touched], lengths)
+    oldCols = graph.nodeIds[graph.indices[entries]]
+    oldDists = numpy.asarray(graph.edgeDist[entries])
+    keep = ~inside(dirty, oldRows) & ~inside(dirty, oldCols)
+    rows = numpy.concatenate((oldRows[keep], rowIds, colIds))
+    cols = numpy.concatenate((oldCols[keep], colIds, rowIds))
+    newDists = numpy.concatenate((oldDists[keep], dists, dists))
+    order = numpy.lexsort((newDists, cols, rows))
+    rows, cols, newDists = rows[order], cols[order], newDists[order]
+    first = numpy.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, newDists = rows[first], cols[first], newDists[first]
+
+    ## which nodes come and go: every node in the graph has at least one edge, so a touched node is in the new graph if, and only
+    ## if, it still has one
+    stillThere = inside(numpy.unique(rows), graph.nodeIds[touched])
+    removed = touched[~stillThere]
+    addedIds = numpy.unique(rows)[~inside(graph.nodeIds, numpy.unique(rows))]
+    sourceAt = numpy.searchsorted(ids, touchedIds)
+    newLon = numpy.asarray(lon)[numpy.minimum(sourceAt, len(ids) - 1)] if len(ids) else numpy.zeros(len(touchedIds))
+    newLat = numpy.asarray(lat)[numpy.minimum(sourceAt, len(ids) - 1)] if len(ids) else numpy.zeros(len(touchedIds))
+    moved = stillThere & ((graph.lon[touched] != newLon[inGraph]) | (graph.lat[touched] != newLat[inGraph]))
+
+    sameEdges = len(rows) == len(oldRows) and (rows == oldRows).all() and (cols == oldCols).all() and (newDists == oldDists).all()
+    if sameEdges and not len(removed) and not len(addedIds) and not moved.any():
+        return graph
+
+    ## the new node arrays, and where each old node ends up in them
+    nodeIds, nodeLon, nodeLat, component = graph.nodeIds, graph.lon, graph.lat, graph.component
+    gone = numpy.zeros(n, dtype=bool)
+    gone[removed] = True
+    remap = numpy.arange(n) - numpy.cumsum(gone) + numpy.searchsorted(addedIds, graph.nodeIds)
+    if len(removed) or len(addedIds):
+        at = numpy.searchsorted(numpy.delete(graph.nodeIds, removed), addedIds)
+        addedAt = numpy.searchsorted(touchedIds, addedIds)
+        nodeIds = numpy.insert(numpy.delete(graph.nodeIds, removed), at, addedIds)
+        nodeLon = numpy.insert(numpy.delete(graph.lon, removed), at, newLon[addedAt])
+        nodeLat = numpy.insert(numpy.delete(graph.lat, removed), at, newLat[addedAt])
+        component = numpy.insert(numpy.delete(graph.component, removed), at, -1)
+    if moved.any():
+        if nodeLon is graph.lon:
+            nodeLon, nodeLat = numpy.array(graph.lon), numpy.array(graph.lat)
+        nodeLon[remap[touched[moved]]] = newLon[inGraph][moved]
+        nodeLat[remap[touched[moved]]] = newLat[inGraph][moved]
+
+    ## the new edges: the untouched rows are copied across (with their nodes renumbered), and the touched rows' new edges are
+    ## slotted in at the start of their rows, where the untouched rows before them end
+    if sameEdges and not len(removed) and not len(addedIds):
+        indptr, indices, edgeDist = graph.indptr, graph.indices, graph.edgeDist
+    else:
+        copied = numpy.ones(len(graph.indices), dtype=bool)
+        copied[entries] = False
+        counts = numpy.zeros(len(nodeIds), dtype=numpy.int64)
+        untouched = numpy.ones(n, dtype=bool)
+        untouched[touched] = False
+        counts[remap[untouched]] = numpy.diff(indptr)[untouched]
+        copiedPtr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        newRows, newCols = numpy.searchsorted(nodeIds, rows), numpy.searchsorted(nodeIds, cols)
+        indices = numpy.insert(remap[graph.indices[copied]].astype(numpy.int32), copiedPtr[newRows], newCols.astype(numpy.int32))
+        edgeDist = numpy.insert(numpy.asarray(graph.edgeDist)[copied], copiedPtr[newRows], newDists)
+        counts += numpy.bincount(newRows, minlength=len(nodeIds))
+        indptr = numpy.zeros(len(nodeIds) + 1, dtype=numpy.int32)
+        numpy.cumsum(counts, out=indptr[1:])
+    patched = WalkGraph(nodeIds, nodeLon, nodeLat, indptr, indices, edgeDist, component)
+
+    ## and the components. If any edge (or node) was taken away, a component may have been split in two, so the components the
+    ## touched nodes were in are labelled again from scratch (the first pieces keep their old labels)
+    oldPairs = set(zip(oldRows.tolist(), oldCols.tolist()))
+    newPairs = set(zip(rows.tolist(), cols.tolist()))
+    if len(removed) or oldPairs - newPairs:
+        labels = numpy.unique(graph.component[touched])
+        affected = numpy.isin(component, labels) | (component == -1)
+        nodesIn = numpy.flatnonzero(affected)
+        count, pieces = connected_components(patched.matrix()[nodesIn][:, nodesIn], directed=True, connection='weak')
+        fresh = numpy.concatenate((labels, graph.component.max() + 1 + numpy.arange(max(count - len(labels), 0))))
+        component = numpy.array(component)
+        component[nodesIn] = fresh[pieces]
+        patched.component = component.astype(numpy.int32)
+        return patched
+
+    # otherwise the components can only have merged, through the new edges: each group of components they join takes the lowest
+    # of its labels, and a group of only new nodes gets a new label of its own
+    newLabel = dict((nodeId, graph.component.max() + 1 + k if len(graph.component) else k) for k, nodeId in enumerate(addedIds.tolist()))
+    labelOf = lambda nodeId, at: newLabel[nodeId] if nodeId in newLabel else int(graph.component[at])
+    parent = {}
+
+    def find(label):
+        while parent.get(label, label) != label:
+            label = parent[label]
+        return label
+
+    for rowId, colId in newPairs - oldPairs:
+        a = find(labelOf(rowId, numpy.searchsorted(graph.nodeIds, rowId)))
+        b = find(labelOf(colId, numpy.searchsorted(graph.nodeIds, colId)))
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    for nodeId in newLabel:
+        parent.setdefault(newLabel[nodeId], newLabel[nodeId])
+
+    merged = [(label, find(label)) for label in parent if find(label) != label]
+    if len(addedIds) or merged:
+        component = numpy.array(component)
+        if len(addedIds):
+            component[numpy.searchsorted(nodeIds, addedIds)] = [find(newLabel[nodeId]) for nodeId in addedIds.tolist()]
+        if merged:
+            fromLabels = numpy.array(sorted(label for label, root in merged), dtype=component.dtype)
+            toLabels = numpy.array([find(label) for label in fromLabels.tolist()], dtype=component.dtype)
+            merging = numpy.isin(component, fromLabels)
+            component[merging] = toLabels[numpy.searchsorted(fromLabels, component[merging])]
+        patched.component = component.astype(numpy.int32)
+    return patched
+
+
+def compileSource(source, bbox=None):
+    '''
+    * Build a WalkGraph from the nodes and walkable ways streamed out of an xml file (see 'osmstream.py'), keeping only
+    * the edges with both ends inside 'bbox' (the nodes around it are only kept for applying change files to)
+    '''
+    ids, lon, lat, wayIds, wayPtr, wayRefs = source
+    rows, cols = wayEdges(ids, wayPtr, wayRefs)
+    keep = inBbox(bbox, lon[rows], lat[rows]) & inBbox(bbox, lon[cols], lat[cols])
+    return compileArrays(*usedNodes(ids, lon, lat, rows[keep], cols[keep]))
+
+
+def saveGraph(graph, cacheDir, source, arrays=None):
+    '''
+    * Write a WalkGraph into 'cacheDir'
+    *
+    * 'source' describes the xml file it was made from. It is written last, into 'meta.json', so a
+    * snapshot that was only half-written is never mistaken for a complete one. A streamed snapshot
+    * also keeps the 'arrays' it was compiled from, in 'source/'.
+    '''
+    # start from an empty folder, so nothing is left over from an older snapshot
+    if os.path.isdir(cacheDir):
+        shutil.rmtree(cacheDir)
+    os.makedirs(cacheDir)
+
+    for name in ARRAYS:
+        numpy.save(os.path.join(cacheDir, name + '.npy'), getattr(graph, name))
+    if arrays is not None:
+        os.makedirs(os.path.join(cacheDir, 'source'))
+        for name, values in zip(SOURCE_ARRAYS, arrays):
+            numpy.save(os.path.join(cacheDir, 'source', name + '.npy'), values)
+
+    writeMeta(cacheDir, dict(source, version=SNAPSHOT_VERSION))
+
+
+def writeMeta(cacheDir, meta):
+    with open(os.path.join(cacheDir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def openGraph(cacheDir):
+    '''
+    * Open a saved WalkGraph, memory-mapping its arrays (so they are only read from disk as they are used)
+    '''
+    return WalkGraph(*[numpy.load(os.path.join(cacheDir, name + '.npy'), mmap_mode='r') for name in ARRAYS])
+
+
+def updateGraph(cacheDir, meta, changes, area):
+    '''
+    * Apply change files to a saved streamed snapshot, rewriting only what they touched, and return its new meta
+    *
+    * The arrays are memory-mapped, and only those that actually changed are written back, each replaced in one go (a
+    * new file renamed over the old one, so any process that still has the old arrays memory-mapped carries on with
+    * them). Raises osmchange.RebuildNeeded if the snapshot has to be built from the xml again instead.
+    '''
+    # (imported here, as osmchange builds on this module)
+    from osmchange import applyChange
+
+    graph = openGraph(cacheDir)
+    arrays = tuple(numpy.load(os.path.join(cacheDir, 'source', name + '.npy'), mmap_mode='r') for name in SOURCE_ARRAYS)
+    before, beforeArrays = [getattr(graph, name) for name in ARRAYS], arrays
+
+    # remove the meta first, so that if anything goes wrong part of the way through, the snapshot is rebuilt next time
+    os.remove(os.path.join(cacheDir, 'meta.json'))
+
+    for change in changes:
+        graph, arrays, touched = applyChange(graph, arrays, change['path'], area['bbox'], frozenset(area['highways']))
+        meta['changes'].append(change)
+        if touched:
+            meta['revision'] = hashlib.sha1((meta['revision'] + change['sha1']).encode('utf-8')).hexdigest()
+
+    for name, old in zip(ARRAYS, before):
+        if getattr(graph, name) is not old:
+            replaceArray(os.path.join(cacheDir, name + '.npy'), getattr(graph, name))
+    for name, values, old in zip(SOURCE_ARRAYS, arrays, beforeArrays):
+        if values is not old:
+            replaceArray(os.path.join(cacheDir, 'source', name + '.npy'), values)
+
+    writeMeta(cacheDir, meta)
+    return meta
+
+
+def replaceArray(path, values):
+    temp = path[:-4] + '.new.npy'
+    numpy.save(temp, values)
+    os.rename(temp, path)
+
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def changeFiles(folder='data/changes'):
+    '''
+    * Return any OSM change files (e.g. the daily diffs from the OSM replication service) that have come out since the OSM xml file
+    * was downloaded, named so that they sort into the order they came out in. These are applied to the walking graph's snapshot
+    * (see 'osmchange.py'), rather than downloading and reading the whole xml file again, and everything that loads the graph
+    * (the main script, 'batch.py' and 'service.py') uses the same ones, so they all walk along the same streets
+    '''
+    return sorted(glob.glob(os.path.join(folder, '*.osc')) + glob.glob(os.path.join(folder, '*.osc.gz')))
+
+
+def snapshotArea(bbox=None, highways=None, changes=()):
+    '''
+    * Return what a streamed snapshot covers (or None for the full osm2nx snapshot)
+    '''
+    if bbox is None and highways is None and not changes:
+        return None
+    return {'bbox': [round(c, 7) for c in bbox] if bbox is not None else None, 'highways': sorted(highways or WALKABLE)}
+
+
+def snapshotDir(xmlPath, area=None):
+    suffix = '.' + hashlib.sha1(json.dumps(area, sort_keys=True).encode('utf-8')).hexdigest()[:10] if area else ''
+    return os.path.splitext(xmlPath)[0] + suffix + '.graph'
+
+
+def updateSnapshot(xmlPath, cacheDir=None, bbox=None, highways=None, changes=(), rebuild=True):
+    '''
+    * Bring the snapshot of an OSM xml file (and any change files) up to date, and return its meta
+    *
+    * The snapshot lives in '<xml name>.graph' next to the xml file, unless 'cacheDir' says otherwise. If
+    * the xml's size and modification time still match the snapshot it is used straight away; if they do
+    * not, the xml is hashed, and only if its content has changed is it parsed again with osm2nx.
+    *
+    * If a 'bbox' (minLon, minLat, maxLon, maxLat), a set of walkable 'highways' tags or any OSM 'changes'
+    * files are given, the xml is streamed through instead (see 'osmstream.py'), keeping only the walkable
+    * ways inside the box. That snapshot is kept apart from the full one, in '<xml name>.<area>.graph'.
+    * Change files are applied to it in the order given, and each only once (see 'osmchange.py'); if one
+    * that has already been applied has since been edited or taken away, or one moves a node into the box
+    * from further away than the snapshot keeps, the snapshot is rebuilt.
+    *
+    * The meta's 'revision' changes whenever the graph does, but not when a change file misses the area
+    * altogether. If 'rebuild' is False and the xml would have to be read, None is returned instead.
+    '''
+    area = snapshotArea(bbox, highways, changes)
+    if cacheDir is None:
+        cacheDir = snapshotDir(xmlPath, area)
+    metaPath = os.path.join(cacheDir, 'meta.json')
+    stat = os.stat(xmlPath)
+    changes = [{'path': path, 'sha1': fileHash(path)} for path in changes]
+
+    meta = None
+    if os.path.exists(metaPath):
+        with open(metaPath) as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION or meta.get('area') != area or changes[:len(meta['changes'])] != meta['changes']:
+            meta = None
+
+    if meta is not None and (meta['size'], meta['mtime']) != (stat.st_size, stat.st_mtime):
+
+        # the file has been touched, but may not have changed: if the content is the same, just note the new time
+        if meta['sha1'] == fileHash(xmlPath):
+            meta.update(size=stat.st_size, mtime=stat.st_mtime)
+            writeMeta(cacheDir, meta)
+        else:
+            meta = None
+
+    if meta is None:
+        if not rebuild:
+            return None
+        sha1 = fileHash(xmlPath)
+        meta = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1, 'area': area, 'changes': [], 'revision': sha1}
+        if area is None:
+            # (osm2nx, and networkx with it, is imported here, so that anything that only uses streamed snapshots never imports it)
+            from osm2nx import read_osm
+            G, nodeIndex = read_osm(xmlPath)
+            saveGraph(compileGraph(G), cacheDir, meta)
+        else:
+            arrays = streamOsm(xmlPath, widenBbox(area['bbox']), frozenset(area['highways']))
+            saveGraph(compileSource(arrays, area['bbox']), cacheDir, meta, arrays)
+        meta['version'] = SNAPSHOT_VERSION
+
+    if len(changes) > len(meta['changes']):
+        # (imported here, as osmchange builds on this module)
+        from osmchange import RebuildNeeded, readChanges
+        applied = dict(meta, changes=list(meta['changes']))
+        try:
+            meta = updateGraph(cacheDir, meta, changes[len(meta['changes']):], area)
+        except RebuildNeeded:
+            # a node was moved into the area from further away than the snapshot keeps, so the ways it is on can only be
+            # found in the xml: stream it again, with every change file read in place of what it changed
+            newChanges = changes[len(applied['changes']):]
+            revision = hashlib.sha1((applied['revision'] + ''.join(change['sha1'] for change in newChanges)).encode('utf-8')).hexdigest()
+            meta = dict(applied, changes=changes, revision=revision)
+            arrays = streamOsm(xmlPath, widenBbox(area['bbox']), frozenset(area['highways']), readChanges([change['path'] for change in changes]))
+            saveGraph(compileSource(arrays, area['bbox']), cacheDir, meta, arrays)
+            meta['version'] = SNAPSHOT_VERSION
+    return meta
+
+
+def snapshotRevision(xmlPath, cacheDir=None, bbox=None, highways=None, changes=()):
+    '''
+    * Return the revision of the snapshot of an OSM xml file, after applying any new change files to it, or
+    * None if it would have to be built from the xml (the xml is new or has changed, or there is no snapshot yet)
+    '''
+    meta = updateSnapshot(xmlPath, cacheDir, bbox, highways, changes, rebuild=False)
+    return meta['revision'] if meta is not None else None
+
+
+def buildSnapshot(xmlPath, cacheDir=None, bbox=None, highways=None, changes=()):
+    '''
+    * Make sure the snapshot of an OSM xml file is up to date (e.g. from another process), and return its revision
+    '''
+    return updateSnapshot(xmlPath, cacheDir, bbox, highways, changes)['revision']
+
+
+def loadGraph(xmlPath, cacheDir=None, bbox=None, highways=None, changes=()):
+    '''
+    * Return the WalkGraph for an OSM xml file, using its snapshot if it is up to date (see 'updateSnapshot')
+    '''
+    if cacheDir is None:
+        cacheDir = snapshotDir(xmlPath, snapshotArea(bbox, highways, changes))
+    updateSnapshot(xmlPath, cacheDir, bbox, highways, changes)
+    return openGraph(cacheDir)
@@ -0,0 +1,404 @@
+'''
+* walkoracle.py
+*
+* Answer many "how far is it to walk from A to B, and which way?" questions on a fixed walking graph, quickly.
+*
+* A walk search (see 'walksearch.py') is the right tool for "everywhere within 30 minutes of the office", but a
+* question between two given points still has to search every street closer to A than B is. So the graph can be
+* prepared once as a 'contraction hierarchy': the nodes are put in order of importance (dead ends and quiet side
+* streets first, through-routes last), and each node in turn is taken out of the graph, with a 'shortcut' added
+* between any two of its neighbours whose shortest path ran through it. Every shortest path then climbs up the order
+* from A and from B to meet at its most important node, so a query only has to search upwards from both ends, which
+* reaches a few hundred nodes instead of the whole city. The answers are exact (the shortcuts are real paths, and
+* are opened back up into streets to give the route).
+*
+* The hierarchy is saved in the graph's snapshot folder (in 'oracle/'), along with the revision of the graph it was
+* built from, so it is built again only when the graph changes.
+*
+* Usage (from this folder, like the main script):
+*
+*   python walkoracle.py build
+*   python walkoracle.py route -2.2345 53.4764 -2.2410 53.4810
+*   python walkoracle.py verify --pairs 500
+'''
+
+import argparse, heapq, json, os, random, shutil, sys, time
+
+import numpy
+from walkgraph import openGraph, snapshotArea, snapshotDir, updateSnapshot, writeMeta
+
+# bump this whenever the way the hierarchy is built or saved changes, so old ones get rebuilt
+ORACLE_VERSION = 1
+
+# the arrays that make up a saved hierarchy (each one is saved as 'oracle/<name>.npy')
+ORACLE_ARRAYS = ('rank', 'upPtr', 'upTo', 'upDist', 'upVia')
+
+# how many nodes a 'witness' search may settle before giving up (giving up early only adds a shortcut that isn't needed)
+WITNESS_LIMIT = 50
+
+
+class WalkOracle(object):
+    '''
+    * A contraction hierarchy of a WalkGraph
+    *
+    * rank[i] is how late node i was contracted. The edges from node i up to the nodes contracted after it go to
+    * upTo[upPtr[i]:upPtr[i+1]] and are upDist[...] metres long. A shortcut edge has the node it was made by taking
+    * out in upVia[...] (and an original street has -1). The graph's streets can be walked both ways, so the same
+    * upward edges serve the searches from both ends.
+    '''
+
+    def __init__(self, graph, rank, upPtr, upTo, upDist, upVia):
+        self.graph = graph
+        self.rank = rank
+        self.upPtr = upPtr
+        self.upTo = upTo
+        self.upDist = upDist
+        self.upVia = upVia
+
+        # the searches step through the edges one at a time, which is far quicker on plain lists than on numpy arrays
+        ptr, to, dist, via = upPtr.tolist(), upTo.tolist(), upDist.tolist(), upVia.tolist()
+        self._up = [list(zip(to[ptr[i]:ptr[i + 1]], dist[ptr[i]:ptr[i + 1]], via[ptr[i]:ptr[i + 1]])) for i in range(len(rank))]
+        self._rank = rank.tolist()
+
+    def _search(self, a, b):
+        '''
+        * Search upwards from array positions 'a' and 'b' at once, and return the length of the shortest path
+        * between them, the node where the two searches meet, and each search's predecessors
+        '''
+        dists = ({a: 0.0}, {b: 0.0})
+        preds = ({a: -1}, {b: -1})
+        queues = ([(0.0, a)], [(0.0, b)])
+        best, meet = numpy.inf, -1
+        side = 0
+        while queues[0] or queues[1]:
+
+            # take turns, unless one side has finished (a side is finished once nothing in its queue can beat the best so far)
+            if not queues[side] or queues[side][0][0] >= best:
+                side = 1 - side
+                if not queues[side] or queues[side][0][0] >= best:
+                    break
+            d, node = heapq.heappop(queues[side])
+            dist, pred, other = dists[side], preds[side], dists[1 - side]
+            if d > dist[node]:
+                continue
+            if node in other and d + other[node] < best:
+                best, meet = d + other[node], node
+
+            # a node that can be reached more cheaply back down from a node higher up is not on a shortest path, so the
+            # search doesn't go on from it (the edges up from a node are also the edges down to it)
+            up = self._up[node]
+            if any(to in dist and dist[to] + length < d for to, length, via in up):
+                side = 1 - side
+                continue
+            for to, length, via in up:
+                through = d + length
+                if through < dist.get(to, numpy.inf):
+                    dist[to] = through
+                    pred[to] = node
+                    heapq.heappush(queues[side], (through, to))
+            side = 1 - side
+        return best, meet, preds
+
+    def distance(self, a, b):
+        '''
+        * Return the length in metres of the shortest walk between nodes 'a' and 'b' (OSM ids), or infinity if there is none
+        '''
+        i, j = self.graph.index(a), self.graph.index(b)
+        if self.graph.component[i] != self.graph.component[j]:
+            return numpy.inf
+        return float(self._search(i, j)[0])
+
+    def route(self, a, b):
+        '''
+        * Return the length in metres of the shortest walk from 'a' to 'b' (OSM ids), and the list of nodes along it
+        * (or infinity and an empty list if there is none)
+        '''
+        i, j = self.graph.index(a), self.graph.index(b)
+        if self.graph.component[i] != self.graph.component[j]:
+            return numpy.inf, []
+        best, meet, preds = self._search(i, j)
+        if meet < 0:
+            return numpy.inf, []
+
+        # the climb from 'a' up to the meeting node, and back down to 'b', as edges of the hierarchy...
+        up = [meet]
+        while preds[0][up[-1]] >= 0:
+            up.append(preds[0][up[-1]])
+        up.reverse()
+        down = [meet]
+        while preds[1][down[-1]] >= 0:
+            down.append(preds[1][down[-1]])
+
+        # ...with each shortcut opened back up into the streets it stands for
+        hops = up + down[1:]
+        path = [hops[0]]
+        for u, v in zip(hops, hops[1:]):
+            path.extend(self._unpack(u, v))
+        return float(best), [self.graph.nodeId(k) for k in path]
+
+    def path(self, a, b):
+        '''
+        * Return the list of nodes along the shortest walk from 'a' to 'b' (OSM ids), or an empty list if there is none
+        '''
+        return self.route(a, b)[1]
+
+    def _unpack(self, u, v):
+        '''
+        * Return the nodes after 'u' along the streets that the hierarchy edge between 'u' and 'v' stands for
+        '''
+        nodes = []
+        todo = [(u, v)]
+        while todo:
+            u, v = todo.pop()
+
+            # the edge is kept with whichever of its two ends was taken out first
+            low, high = (u, v) if self._rank[u] < self._rank[v] else (v, u)
+            via = [via for to, length, via in self._up[low] if to == high][0]
+            if via < 0:
+                nodes.append(v)
+            else:
+                # (last in, first out, so the second half goes on first)
+                todo.append((via, v))
+                todo.append((u, via))
+        return nodes
+
+
+def contract(graph):
+    '''
+    * Build the contraction hierarchy of a WalkGraph, and return it as arrays (see 'WalkOracle')
+    *
+    * The next node to take out is always the one with the lowest score: twice the number of shortcuts it adds less
+    * the number of streets it removes (its 'edge difference'), plus how many of its neighbours have been taken out
+    * already, so the contraction spreads evenly over the city. Taking a node out changes the scores of its neighbours,
+    * so they are scored again; any other score that has gone stale is caught when it comes to the front of the queue.
+    '''
+    n = len(graph)
+    indptr, indices, edgeDist = graph.indptr.tolist(), graph.indices.tolist(), graph.edgeDist.tolist()
+
+    # what is left of the graph, as node -> {neighbour: (length, via)} (the graph's edges are stored both ways round)
+    adj = [dict() for i in range(n)]
+    for i in range(n):
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            if j != i and (j not in adj[i] or edgeDist[k] < adj[i][j][0]):
+                adj[i][j] = (edgeDist[k], -1)
+
+    contracted = [False] * n
+    taken = [0] * n
+    rank = numpy.zeros(n, dtype=numpy.int32)
+    upFrom, upTo, upDist, upVia = [], [], [], []
+
+    def shortcuts(v):
+        # every pair of v's neighbours whose shortest path (apart from v itself) is longer than the way through v needs a shortcut
+        # (by more than a micrometre, so that ways round that are just as long, which a grid of streets is full of, don't need one)
+        found = []
+        neighbours = list(adj[v].items())
+        for k, (u, (du, viaU)) in enumerate(neighbours):
+            others = neighbours[k + 1:]
+            if not others:
+                continue
+            limit = du + max(dw for w, (dw, viaW) in others)
+            witness = witnessSearch(adj, u, v, [w for w, (dw, viaW) in others], limit)
+            for w, (dw, viaW) in others:
+                if witness.get(w, numpy.inf) > du + dw + 1e-6:
+                    found.append((u, w, du + dw))
+        return found
+
+    def scoreOf(v, found):
+        return 2 * (len(found) - len(adj[v])) + taken[v]
+
+    # each node's latest score (the queue can also hold older scores for it, which are skipped)
+    score = [scoreOf(v, shortcuts(v)) for v in range(n)]
+    queue = [(priority, v) for v, priority in enumerate(score)]
+    heapq.heapify(queue)
+    taking = 0
+    while queue:
+        priority, v = heapq.heappop(queue)
+        if contracted[v] or priority != score[v]:
+            continue
+
+        # score the node again in case it has gone stale, and put it back if something else should go first
+        found = shortcuts(v)
+        score[v] = scoreOf(v, found)
+        if queue and score[v] > queue[0][0]:
+            heapq.heappush(queue, (score[v], v))
+            continue
+
+        # add the shortcuts (unless there is already a street or shortcut as short), and note v's edges up the order
+        for u, w, length in found:
+            if length < adj[u].get(w, (numpy.inf,))[0]:
+                adj[u][w] = (length, v)
+                adj[w][u] = (length, v)
+        rank[v] = taking
+        taking += 1
+        contracted[v] = True
+        for u, (length, via) in adj[v].items():
+            upFrom.append(v)
+            upTo.append(u)
+            upDist.append(length)
+            upVia.append(via)
+            del adj[u][v]
+            taken[u] += 1
+        neighbours = list(adj[v])
+        adj[v] = {}
+        for u in neighbours:
+            score[u] = scoreOf(u, shortcuts(u))
+            heapq.heappush(queue, (score[u], u))
+
+    # the upward edges were noted in the order the nodes were taken out, so put them in node order
+    upFrom = numpy.array(upFrom, dtype=numpy.int64)
+    order = numpy.argsort(upFrom, kind='mergesort')
+    upPtr = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(upFrom, minlength=n), out=upPtr[1:])
+    upTo = numpy.array(upTo, dtype=numpy.int32)[order]
+    upDist = numpy.array(upDist, dtype=numpy.float64)[order]
+    upVia = numpy.array(upVia, dtype=numpy.int32)[order]
+    return rank, upPtr, upTo, upDist, upVia
+
+
+def witnessSearch(adj, source, skip, targets, limit):
+    '''
+    * Return the shortest distances from 'source' (that don't pass through 'skip') to as many of 'targets' as are found,
+    * searching no further than 'limit' metres and settling no more than WITNESS_LIMIT nodes
+    '''
+    dist = {source: 0.0}
+    queue = [(0.0, source)]
+    left = set(targets)
+    settled = 0
+    while queue and left and settled < WITNESS_LIMIT:
+        d, node = heapq.heappop(queue)
+        if d > dist[node]:
+            continue
+        left.discard(node)
+        settled += 1
+        for to, (length, via) in adj[node].items():
+            through = d + length
+            if through <= limit and to != skip and through < dist.get(to, numpy.inf):
+                dist[to] = through
+                heapq.heappush(queue, (through, to))
+    return dist
+
+
+def saveOracle(arrays, oracleDir, revision):
+    '''
+    * Write the hierarchy's arrays into 'oracleDir', and last of all a 'meta.json' with the graph revision it was built from
+    '''
+    if os.path.isdir(oracleDir):
+        shutil.rmtree(oracleDir)
+    os.makedirs(oracleDir)
+    for name, values in zip(ORACLE_ARRAYS, arrays):
+        numpy.save(os.path.join(oracleDir, name + '.npy'), values)
+    writeMeta(oracleDir, {'revision': revision, 'version': ORACLE_VERSION})
+
+
+def loadOracle(xmlPath, cacheDir=None, bbox=None, highways=None, changes=()):
+    '''
+    * Return the WalkOracle for the walking graph of an OSM xml file (see 'loadGraph' for the other arguments)
+    *
+    * The hierarchy is kept in the graph snapshot's 'oracle' folder, and is only built again when the graph's
+    * revision has changed since it was made (so a change file that misses the graph doesn't force a rebuild).
+    '''
+    if cacheDir is None:
+        cacheDir = snapshotDir(xmlPath, snapshotArea(bbox, highways, changes))
+    revision = updateSnapshot(xmlPath, cacheDir, bbox, highways, changes)['revision']
+    graph = openGraph(cacheDir)
+
+    oracleDir = os.path.join(cacheDir, 'oracle')
+    metaPath = os.path.join(oracleDir, 'meta.json')
+    meta = None
+    if os.path.exists(metaPath):
+        with open(metaPath) as f:
+            meta = json.load(f)
+    if meta != {'revision': revision, 'version': ORACLE_VERSION}:
+        saveOracle(contract(graph), oracleDir, revision)
+    return WalkOracle(graph, *[numpy.load(os.path.join(oracleDir, name + '.npy')) for name in ORACLE_ARRAYS])
+
+
+def verifyOracle(oracle, pairs=200, seed=1):
+    '''
+    * Check the oracle's answers against networkx on random pairs of nodes, and return a list of the pairs it got wrong
+    *
+    * Each answer must be the same length as networkx's Dijkstra (to a millimetre), and its route must be made of real
+    * streets that add up to that length. The time each takes is printed as well.
+    '''
+    import networkx as nx
+
+    graph = oracle.graph
+    G = nx.Graph()
+    rows = numpy.repeat(numpy.arange(len(graph)), numpy.diff(graph.indptr))
+    G.add_weighted_edges_from(((graph.nodeId(i), graph.nodeId(j), float(d)) for i, j, d in zip(rows, graph.indices, graph.edgeDist)), weight='distance')
+
+    rng = random.Random(seed)
+    wrong = []
+    oracleTime, nxTime = 0.0, 0.0
+    for k in range(pairs):
+        a, b = graph.nodeId(rng.randrange(len(graph))), graph.nodeId(rng.randrange(len(graph)))
+
+        t = time.time()
+        dist, path = oracle.route(a, b)
+        oracleTime += time.time() - t
+
+        t = time.time()
+        try:
+            expected, expectedPath = nx.single_source_dijkstra(G, a, b, weight='distance')
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            expected = numpy.inf
+        nxTime += time.time() - t
+
+        if numpy.isinf(expected):
+            ok = numpy.isinf(dist) and not path
+        else:
+            walked = sum(G[u][v]['distance'] if G.has_edge(u, v) else numpy.inf for u, v in zip(path, path[1:]))
+            ok = abs(dist - expected) <= 1e-3 and abs(walked - expected) <= 1e-3 and path[0] == a and path[-1] == b
+        if not ok:
+            wrong.append((a, b, dist, expected))
+
+    print('%d pairs checked, %d wrong' % (pairs, len(wrong)))
+    if pairs:
+        print('oracle: %.3f ms a query, networkx: %.3f ms a query (%.0f times faster)' %
+              (1000 * oracleTime / pairs, 1000 * nxTime / pairs, nxTime / max(oracleTime, 1e-9)))
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer shortest walking distance questions from a prepared copy of the walking graph.')
+    parser.add_argument('--graph', default='data/manchester.xml', help='the OSM xml file of the street network')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('build', help='prepare the graph (if it has changed since last time)')
+
+    route = commands.add_parser('route', help='find the shortest walk between two points')
+    for name in ('from_lon', 'from_lat', 'to_lon', 'to_lat'):
+        route.add_argument(name, type=float)
+
+    verify = commands.add_parser('verify', help='check the answers against networkx on random pairs of nodes')
+    verify.add_argument('--pairs', type=int, default=200, help='the number of pairs to check (default: 200)')
+    verify.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    started = time.time()
+    oracle = loadOracle(args.graph)
+
+    if args.command == 'route':
+        graph = oracle.graph
+        a, b = graph.nearestNode(args.from_lon, args.from_lat), graph.nearestNode(args.to_lon, args.to_lat)
+        dist, path = oracle.route(a, b)
+        if not path:
+            sys.exit('there is no walk between those two points')
+        json.dump({'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': graph.lineCoordinates(path)},
+                   'properties': {'walk_dist': round(dist, 1)}}, sys.stdout)
+        print('')
+        return
+
+    print('ready in %.1f s (%d nodes, %d upward edges)' % (time.time() - started, len(oracle.rank), len(oracle.upTo)))
+    if args.command == 'verify':
+        if verifyOracle(oracle, args.pairs, args.seed):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+* walksearch.py
+*
+* A single-source, distance-limited walk search over the compiled walking graph (see 'walkgraph.py').
+*
+* Instead of running has_path and then A* from the office to every single cafe (which explores the
+* same streets again and again), Dijkstra's algorithm is run ONCE from the office and stopped as soon
+* as it gets further than the walking distance limit. Every node it reaches is kept in a shortest-path
+* tree, so "can Jonny walk there, and how far is it?" is an array lookup for any number of cafes.
+'''
+
+import numpy
+from scipy.sparse.csgraph import dijkstra
+
+
+class WalkTree(object):
+    '''
+    * The shortest-path tree grown from a single source node.
+    *
+    * 'dist' holds, for every node of the graph, the length of its shortest path in metres (the sum of the
+    * Airy ellipsoid edge lengths stored in the graph, or infinity if it was not reached), and 'pred' holds
+    * the array position of the node before it on that path.
+    '''
+
+    def __init__(self, graph, source, dist, pred):
+        self.graph = graph
+        self.source = graph.index(source)
+        self.dist = dist
+        self.pred = pred
+
+    def expanded(self):
+        '''
+        * Return the number of nodes the search reached (before it hit the walking distance limit)
+        '''
+        return int(numpy.isfinite(self.dist).sum())
+
+    def reaches(self, node):
+        return bool(numpy.isfinite(self.dist[self.graph.index(node)]))
+
+    def pathTo(self, node):
+        '''
+        * Return the list of nodes from the source to 'node', or an empty list if it was not reached
+        '''
+        if not self.reaches(node):
+            return []
+        path = [self.graph.index(node)]
+        while path[-1] != self.source:
+            path.append(int(self.pred[path[-1]]))
+        path.reverse()
+        return [self.graph.nodeId(i) for i in path]
+
+    def distanceTo(self, node):
+        '''
+        * Return the ellipsoidal length of the path to 'node' in metres, or infinity if it was not reached
+        '''
+        return float(self.dist[self.graph.index(node)])
+
+    def distancesTo(self, nodes):
+        '''
+        * Return an array of the path lengths to each of 'nodes' at once (infinity for None or unreached nodes)
+        '''
+        known = numpy.array([n is not None for n in nodes], dtype=bool)
+        dists = numpy.full(len(nodes), numpy.inf)
+        ids = numpy.array([int(n) for n in nodes if n is not None], dtype=numpy.int64)
+        dists[known] = self.dist[numpy.searchsorted(self.graph.nodeIds, ids)]
+        return dists
+
+    def routeCounts(self, nodes):
+        '''
+        * Return how many of the routes to 'nodes' (a list of node ids, which may include None) use each street of the tree
+        *
+        * counts[i] is the number of routes along the street from node pred[i] to node i. Every route to a node runs
+        * through the street into it, so each node's count is simply the number of routes that end there plus the counts
+        * of the streets leaving it. These are added up from the tips of the tree inwards, one level at a time (each node
+        * is handled once, as soon as all of its branches have been), so this takes time in proportion to the tree's size.
+        '''
+        n = len(self.dist)
+        reached = numpy.isfinite(self.dist)
+        targets = numpy.array([self.graph.index(node) for node in nodes if node is not None], dtype=numpy.int64)
+        counts = numpy.bincount(targets, minlength=n).astype(numpy.int64)
+        counts[~reached] = 0
+
+        # note how many branches leave each node, and start from the nodes with none (the tips of the tree)
+        parent = numpy.asarray(self.pred)
+        hasParent = reached & (parent >= 0)
+        branches = numpy.bincount(parent[hasParent], minlength=n)
+        frontier = numpy.flatnonzero(hasParent & (branches == 0))
+        while len(frontier):
+            up = parent[frontier]
+            numpy.add.at(counts, up, counts[frontier])
+            numpy.subtract.at(branches, up, 1)
+            up = numpy.unique(up)
+            frontier = up[(branches[up] == 0) & hasParent[up]]
+        return counts
+
+    def routeStreets(self, nodes):
+        '''
+        * Return each street used by the routes to 'nodes', once, as (from node id, to node id, number of routes along it)
+        '''
+        counts = self.routeCounts(nodes)
+        return [(self.graph.nodeId(self.pred[i]), self.graph.nodeId(i), int(counts[i])) for i in numpy.flatnonzero(counts) if self.pred[i] >= 0]
+
+
+def walkSearch(graph, source, maxDist=numpy.inf):
+    '''
+    * Grow a WalkTree from 'source' over a WalkGraph, stopping once paths get longer than 'maxDist'
+    '''
+    dist, pred = dijkstra(graph.matrix(), directed=True, indices=graph.index(source), return_predecessors=True, limit=maxDist)
+    return WalkTree(graph, source, dist, pred)
+
+
+def shortestPath(graph, source, target):
+    '''
+    * Return the list of nodes on the shortest path from 'source' to 'target' (empty if there is none)
+    '''
+    if not graph.connected(source, target):
+        return []
+    return walkSearch(graph, source).pathTo(target)